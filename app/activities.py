@@ -1,5 +1,4 @@
 import time
-import subprocess
 import json
 import asyncio
 import aiohttp
@@ -8,10 +7,74 @@ import os
 import logging
 from temporalio import activity
 
+from .models import Text2ImageRequest
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session for talking to the image generation service.
+# Created lazily on first use so module import stays cheap and the session
+# is bound to the worker's event loop. Reusing one session keeps connections
+# alive across activity invocations and across the per-task status polls,
+# avoiding a fresh TCP + TLS handshake on every request.
+_session: aiohttp.ClientSession | None = None
+
+def _make_resolver():
+    """Use the aiodns-backed resolver when available (optional, like uvloop).
+
+    The default resolver runs blocking getaddrinfo calls on the thread pool;
+    AsyncResolver keeps lookups on the event loop.
+    """
+    try:
+        import aiodns  # noqa: F401
+        return aiohttp.resolver.AsyncResolver()
+    except ImportError:
+        return None
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Get (or lazily create) the shared aiohttp session."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=75,  # match nginx's default keepalive
+                resolver=_make_resolver(),
+                ttl_dns_cache=300,  # cache lookups of the service hostname
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, connect=10),
+        )
+    return _session
+
+# Docker Engine API socket. Talking to the daemon directly avoids a
+# fork/exec of the docker CLI per health check and keeps the inspect calls
+# on the worker's event loop. When the socket is absent (Windows, rootless
+# setups) we fall back to the docker CLI via subprocess.
+_DOCKER_SOCKET = os.getenv("DOCKER_SOCKET", "/var/run/docker.sock")
+_docker_session: aiohttp.ClientSession | None = None
+
+async def _get_docker_session() -> aiohttp.ClientSession:
+    """Get (or lazily create) the shared Docker Engine API session."""
+    global _docker_session
+    if _docker_session is None or _docker_session.closed:
+        _docker_session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=_DOCKER_SOCKET),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+    return _docker_session
+
+async def close_session():
+    """Close the shared HTTP sessions. Called on worker shutdown."""
+    global _session, _docker_session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    if _docker_session is not None and not _docker_session.closed:
+        await _docker_session.close()
+    _docker_session = None
+
 @activity.defn
 async def say_hello(name: str) -> str:
     """Simple hello activity with heartbeat."""
@@ -19,66 +82,114 @@ async def say_hello(name: str) -> str:
     await asyncio.sleep(0.5)
     return f"Hello, {name}!"
 
-@activity.defn
-async def check_container_health(container_name: str) -> dict:
-    """Check the health of a Docker container."""
-    activity.heartbeat()
-    
+async def _inspect_container_api(container_name: str) -> dict:
+    """Inspect a container via the Docker Engine API over the Unix socket."""
+    session = await _get_docker_session()
+    async with session.get(f"http://docker/containers/{container_name}/json") as response:
+        if response.status == 404:
+            return {
+                "status": "error",
+                "error": f"Container {container_name} not found",
+                "container": container_name
+            }
+        if response.status != 200:
+            return {
+                "status": "error",
+                "error": f"Docker API returned status {response.status}",
+                "container": container_name
+            }
+        container_info = await response.json()
+
+    parsed = _parse_container_state(container_info)
+    parsed["container"] = container_name
+    return parsed
+
+async def _run_docker_inspect(names: list[str], timeout: float) -> tuple[int, str]:
+    """Run `docker inspect` without blocking the event loop.
+
+    Returns (returncode, stdout). Raises asyncio.TimeoutError after killing
+    the subprocess if it exceeds the timeout.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "docker", "inspect", *names,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout.decode()
+
+async def _inspect_container_subprocess(container_name: str) -> dict:
+    """Inspect a container via the docker CLI (fallback path)."""
     try:
         # Check if container exists and get its status
-        result = subprocess.run(
-            ["docker", "inspect", container_name],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        if result.returncode != 0:
+        returncode, stdout = await _run_docker_inspect([container_name], timeout=10)
+
+        if returncode != 0:
             return {
                 "status": "error",
                 "error": f"Container {container_name} not found",
                 "container": container_name
             }
-        
+
         # Parse the container info
-        container_info = json.loads(result.stdout)[0]
-        state = container_info.get("State", {})
-        
-        # Check if container is running
-        is_running = state.get("Running", False)
-        exit_code = state.get("ExitCode", 0)
-        
-        # Get health check status if available
-        health_status = "unknown"
-        if "Health" in state:
-            health_status = state["Health"].get("Status", "unknown")
-        
-        # Determine overall health
-        if is_running and (health_status == "healthy" or health_status == "unknown"):
-            status = "healthy"
-        elif is_running and health_status == "unhealthy":
-            status = "unhealthy"
-        elif not is_running and exit_code == 0:
-            status = "stopped"
-        else:
-            status = "unhealthy"
-        
-        return {
-            "status": status,
-            "container": container_name,
-            "running": is_running,
-            "exit_code": exit_code,
-            "health_status": health_status,
-            "started_at": state.get("StartedAt"),
-            "finished_at": state.get("FinishedAt")
-        }
-        
-    except subprocess.TimeoutExpired:
+        container_info = json.loads(stdout)[0]
+        parsed = _parse_container_state(container_info)
+        parsed["container"] = container_name
+        return parsed
+
+    except asyncio.TimeoutError:
         return {
             "status": "error",
             "error": f"Timeout checking container {container_name}",
             "container": container_name
         }
+
+# Container state is quasi-static over a window of seconds, so repeated
+# health queries (concurrent workflows, external pollers) can share a
+# recent inspect result instead of hitting Docker every time. Errors are
+# never cached so a transient failure doesn't poison subsequent checks.
+_INSPECT_CACHE_TTL = 2.0
+_inspect_cache: dict[str, tuple[float, dict]] = {}
+_inspect_locks: dict[str, asyncio.Lock] = {}
+
+async def _inspect_container_cached(container_name: str) -> dict:
+    """Inspect a container, reusing a recent result within the TTL.
+
+    A per-container lock collapses concurrent cache misses so only one
+    inspect is in flight per container at a time.
+    """
+    cached = _inspect_cache.get(container_name)
+    if cached and time.monotonic() - cached[0] < _INSPECT_CACHE_TTL:
+        return cached[1]
+
+    lock = _inspect_locks.setdefault(container_name, asyncio.Lock())
+    async with lock:
+        # Another task may have refreshed the entry while we waited
+        cached = _inspect_cache.get(container_name)
+        if cached and time.monotonic() - cached[0] < _INSPECT_CACHE_TTL:
+            return cached[1]
+
+        if os.path.exists(_DOCKER_SOCKET):
+            result = await _inspect_container_api(container_name)
+        else:
+            result = await _inspect_container_subprocess(container_name)
+
+        if result.get("status") != "error":
+            _inspect_cache[container_name] = (time.monotonic(), result)
+        return result
+
+@activity.defn
+async def check_container_health(container_name: str) -> dict:
+    """Check the health of a Docker container."""
+    activity.heartbeat()
+
+    try:
+        return await _inspect_container_cached(container_name)
     except Exception as e:
         return {
             "status": "error",
@@ -86,21 +197,150 @@ async def check_container_health(container_name: str) -> dict:
             "container": container_name
         }
 
+def _parse_container_state(container_info: dict) -> dict:
+    """Build a health result dict from a docker inspect entry."""
+    container_name = container_info.get("Name", "").lstrip("/")
+    state = container_info.get("State", {})
+
+    # Check if container is running
+    is_running = state.get("Running", False)
+    exit_code = state.get("ExitCode", 0)
+
+    # Get health check status if available
+    health_status = "unknown"
+    if "Health" in state:
+        health_status = state["Health"].get("Status", "unknown")
+
+    # Determine overall health
+    if is_running and (health_status == "healthy" or health_status == "unknown"):
+        status = "healthy"
+    elif is_running and health_status == "unhealthy":
+        status = "unhealthy"
+    elif not is_running and exit_code == 0:
+        status = "stopped"
+    else:
+        status = "unhealthy"
+
+    return {
+        "status": status,
+        "container": container_name,
+        "running": is_running,
+        "exit_code": exit_code,
+        "health_status": health_status,
+        "started_at": state.get("StartedAt"),
+        "finished_at": state.get("FinishedAt")
+    }
+
 @activity.defn
-async def generate_image_from_text(args: tuple) -> dict:
+async def check_containers_health(names: list[str]) -> dict:
+    """Check the health of multiple Docker containers with one inspect call.
+
+    Runs `docker inspect name1 name2 ...` once instead of forking a
+    subprocess per container, and maps the resulting JSON array back to the
+    requested names. Containers docker could not find get an error entry.
+    """
+    activity.heartbeat()
+
+    results = {
+        name: {
+            "status": "error",
+            "error": f"Container {name} not found",
+            "container": name
+        }
+        for name in names
+    }
+
+    if not names:
+        return results
+
+    # Prefer the Docker Engine API: with the shared Unix-socket session the
+    # per-container inspects are just concurrent socket I/O, no subprocesses.
+    if os.path.exists(_DOCKER_SOCKET):
+        inspected = await asyncio.gather(
+            *(_inspect_container_cached(name) for name in names),
+            return_exceptions=True
+        )
+        for name, parsed in zip(names, inspected):
+            if isinstance(parsed, Exception):
+                results[name] = {
+                    "status": "error",
+                    "error": str(parsed),
+                    "container": name
+                }
+            else:
+                results[name] = parsed
+        return results
+
+    try:
+        _, stdout = await _run_docker_inspect(names, timeout=10 + len(names))
+
+        # docker inspect returns non-zero if any container is missing, but
+        # still emits a JSON array for the ones it found.
+        for container_info in json.loads(stdout or "[]"):
+            parsed = _parse_container_state(container_info)
+            if parsed["container"] in results:
+                results[parsed["container"]] = parsed
+
+        return results
+
+    except asyncio.TimeoutError:
+        return {
+            name: {
+                "status": "error",
+                "error": f"Timeout checking container {name}",
+                "container": name
+            }
+            for name in names
+        }
+    except Exception as e:
+        return {
+            name: {
+                "status": "error",
+                "error": str(e),
+                "container": name
+            }
+            for name in names
+        }
+
+async def _watch_task_events(session: aiohttp.ClientSession, microservice_url: str,
+                             task_id: str) -> bool:
+    """Subscribe to a task's WebSocket progress events if the service has them.
+
+    Returns True once the task completes, raises on a failure event, and
+    returns False when the events endpoint is unavailable (older service
+    versions) so the caller can fall back to status polling.
+    """
+    try:
+        async with session.ws_connect(f"{microservice_url}/events/{task_id}") as ws:
+            logger.info(f"Subscribed to progress events for task {task_id}")
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = msg.json()
+                activity.heartbeat(task_id, data.get("progress"))
+                status = data.get("status")
+                if status == "completed":
+                    return True
+                if status == "failed":
+                    error_msg = data.get("error", "Unknown error")
+                    logger.error(f"Task {task_id} failed: {error_msg}")
+                    raise Exception(f"Generation failed: {error_msg}")
+    except aiohttp.ClientError:
+        logger.info("Progress event stream unavailable, falling back to status polling")
+    return False
+
+@activity.defn
+async def generate_image_from_text(req: Text2ImageRequest) -> dict:
     """Generate an image from text prompt using local GPU models via microservice."""
-    # Unpack the arguments
-    prompt, model, negative_prompt, width, height, steps, cfg_scale, seed = args
-    
-    # Set defaults if not provided
-    model = model or "runwayml/stable-diffusion-v1-5"
-    negative_prompt = negative_prompt or ""
-    width = width or 512
-    height = height or 512
-    steps = steps or 30
-    cfg_scale = cfg_scale or 5
-    
-    
+    prompt = req.prompt
+    model = req.model
+    negative_prompt = req.negative_prompt
+    width = req.width
+    height = req.height
+    steps = req.steps
+    cfg_scale = req.cfg_scale
+    seed = req.seed
+
     logger.info(f"Starting image generation activity with prompt: {prompt[:50]}...")
     activity.heartbeat()
     
@@ -118,89 +358,158 @@ async def generate_image_from_text(args: tuple) -> dict:
         "steps": steps,
         "cfg_scale": cfg_scale,
         "seed": seed if seed is not None else -1,  # -1 for random seed
-        "sampler": "euler",  # Default sampler
+        # sampler is omitted on purpose: the service defaults to its
+        # configured SDE-DPM++ solver, and pinning "euler" here would
+        # silently swap it out on every production request
         "scheduler": "normal"  # Default scheduler
     }
     
-    logger.info(f"Generation request: {json.dumps(generation_request)}")
-    
+    # Serialize once: the same bytes feed both the log line and the POST
+    # body (session.post(json=...) would re-serialize). Lazy %s formatting
+    # keeps the log call free when the handler filters it out.
+    payload = json.dumps(generation_request).encode()
+    logger.info("Generation request: %s", payload)
+
     try:
-        async with aiohttp.ClientSession() as session:
+        session = await _get_session()
+
+        # If a previous attempt of this activity already created the task,
+        # its id was checkpointed in heartbeat details — resume polling it
+        # instead of re-posting /generate and burning a second GPU run.
+        task_id = None
+        heartbeat_details = activity.info().heartbeat_details
+        if heartbeat_details:
+            task_id = heartbeat_details[0]
+            logger.info(f"Resuming polling of existing task {task_id} from heartbeat details")
+
+        if not task_id:
             # Start generation
             activity.heartbeat()
             logger.info("Sending request to image generation service...")
-            async with session.post(f"{microservice_url}/generate", 
-                                   json=generation_request) as response:
+            async with session.post(f"{microservice_url}/generate",
+                                   data=payload,
+                                   headers={"Content-Type": "application/json"}) as response:
                 if response.status != 200:
                     error_text = await response.text()
                     logger.error(f"Generation request failed with status {response.status}: {error_text}")
                     raise Exception(f"Generation failed: {error_text}")
-                
+
                 result = await response.json()
                 logger.info(f"Generation started with task_id: {result.get('task_id')}")
-                
-                # Poll for completion
-                task_id = result.get("task_id")
-                if not task_id:
-                    logger.error("No task ID returned from generation service")
-                    raise Exception("No task ID returned from generation service")
-                
-                # Poll for completion with progress updates
-                while True:
-                    activity.heartbeat()
-                    await asyncio.sleep(1)  # Poll every second
-                    
-                    logger.info(f"Checking status for task {task_id}...")
-                    async with session.get(f"{microservice_url}/status/{task_id}") as status_response:
-                        if status_response.status != 200:
-                            logger.error(f"Failed to get status with code {status_response.status}")
-                            raise Exception("Failed to get generation status")
-                        
-                        status_data = await status_response.json()
-                        status = status_data.get("status")
-                        logger.info(f"Task {task_id} status: {status}, progress: {status_data.get('progress')}%")
-                        
-                        if status == "completed":
-                            # Get the final result
-                            logger.info(f"Task {task_id} completed, fetching result...")
-                            async with session.get(f"{microservice_url}/result/{task_id}") as result_response:
-                                if result_response.status != 200:
-                                    logger.error(f"Failed to get result with code {result_response.status}")
-                                    raise Exception("Failed to get generation result")
-                                
-                                final_result = await result_response.json()
-                                logger.info(f"Successfully received result for task {task_id}")
-                                
-                                return {
-                                    "image_url": final_result.get("image_url"),
-                                    "image_data": final_result.get("image_data"),  # Base64 encoded
-                                    "prompt": prompt,
-                                    "model": model,
-                                    "metadata": {
-                                        "generation_time": final_result.get("generation_time"),
-                                        "model_version": final_result.get("model_version"),
-                                        "resolution": f"{width}x{height}",
-                                        "steps": steps,
-                                        "cfg_scale": cfg_scale,
-                                        "seed": final_result.get("seed"),
-                                        "sampler": "euler",
-                                        "scheduler": "normal"
-                                    }
-                                }
-                        
-                        elif status == "failed":
-                            error_msg = status_data.get("error", "Unknown error")
-                            logger.error(f"Task {task_id} failed: {error_msg}")
-                            raise Exception(f"Generation failed: {error_msg}")
-                        
-                        elif status == "processing" or status == "running":
-                            # Continue polling
-                            continue
-                        
-                        else:
-                            logger.error(f"Unknown status: {status}")
-                            raise Exception(f"Unknown status: {status}")
-    
+
+            task_id = result.get("task_id")
+            if not task_id:
+                logger.error("No task ID returned from generation service")
+                raise Exception("No task ID returned from generation service")
+
+            # Checkpoint the task id immediately so a retry can resume
+            activity.heartbeat(task_id)
+
+        # Prefer push-based progress events when the service exposes them —
+        # that removes the entire poll loop and gives sub-second progress.
+        completed = await _watch_task_events(session, microservice_url, task_id)
+
+        # Poll for completion with progress updates. Start polling quickly so
+        # fast generations complete with low latency, then back off
+        # exponentially (capped at 2s) to avoid hammering the service on
+        # long-running generations.
+        delay = 0.1
+        while not completed:
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 2.0)
+
+            logger.info(f"Checking status for task {task_id}...")
+            async with session.get(f"{microservice_url}/status/{task_id}") as status_response:
+                if status_response.status != 200:
+                    logger.error(f"Failed to get status with code {status_response.status}")
+                    raise Exception("Failed to get generation status")
+
+                status_data = await status_response.json()
+
+            status = status_data.get("status")
+            logger.info(f"Task {task_id} status: {status}, progress: {status_data.get('progress')}%")
+            # Heartbeat with the task id first so retries can resume this
+            # task; progress rides along for visibility between polls.
+            activity.heartbeat(task_id, status_data.get("progress"))
+
+            if status == "completed":
+                completed = True
+
+            elif status == "failed":
+                error_msg = status_data.get("error", "Unknown error")
+                logger.error(f"Task {task_id} failed: {error_msg}")
+                raise Exception(f"Generation failed: {error_msg}")
+
+            elif status in ("pending", "queued", "processing", "running"):
+                # pending: BackgroundTasks hasn't picked the task up yet;
+                # queued: waiting its turn on the GPU semaphore. Both are
+                # normal in-progress states under contention.
+                continue
+
+            else:
+                # The 0.1s first poll means we can observe transient or
+                # newly added service states; only "failed" is worth
+                # killing the workflow over, so log and keep polling
+                logger.warning(f"Unknown status: {status}, continuing to poll")
+                continue
+
+        # Get the final result
+        logger.info(f"Task {task_id} completed, fetching result...")
+        async with session.get(f"{microservice_url}/result/{task_id}") as result_response:
+            if result_response.status != 200:
+                logger.error(f"Failed to get result with code {result_response.status}")
+                raise Exception("Failed to get generation result")
+
+            final_result = await result_response.json()
+
+        logger.info(f"Successfully received result for task {task_id}")
+
+        # When an image store is configured, upload the image there
+        # and return only its URL. Keeping ~900 KB of base64 out of
+        # the activity result keeps Temporal workflow histories
+        # small; the inline base64 path remains the dev-mode
+        # fallback.
+        image_url = final_result.get("image_url")
+        image_data = final_result.get("image_data")  # Base64 encoded
+        image_store_url = os.getenv("IMAGE_STORE_URL")
+        # The service reports what it actually encoded (WebP by default);
+        # older builds omit the fields, which did ship PNG
+        mime_type = final_result.get("mime_type", "image/png")
+        image_format = final_result.get("format", "png")
+        if image_store_url and image_data:
+            ext = "jpg" if image_format == "jpeg" else image_format
+            stored_url = f"{image_store_url}/{task_id}.{ext}"
+            async with session.put(stored_url,
+                                   data=base64.b64decode(image_data),
+                                   headers={"Content-Type": mime_type}) as store_response:
+                if store_response.status in (200, 201, 204):
+                    image_url = store_response.headers.get("Location", stored_url)
+                    image_data = None
+                    logger.info(f"Uploaded image for task {task_id} to {image_url}")
+                else:
+                    logger.warning(
+                        f"Image store returned status {store_response.status}, "
+                        "falling back to inline image data"
+                    )
+
+        return {
+            "image_url": image_url,
+            "image_data": image_data,  # Base64 encoded (None when stored out-of-band)
+            "mime_type": mime_type,
+            "prompt": prompt,
+            "model": model,
+            "metadata": {
+                "generation_time": final_result.get("generation_time"),
+                "model_version": final_result.get("model_version"),
+                "resolution": f"{width}x{height}",
+                "steps": steps,
+                "cfg_scale": cfg_scale,
+                "seed": final_result.get("seed"),
+                "sampler": "dpm++",  # The service default; requests don't override it
+                "scheduler": "normal"
+            }
+        }
+
     except aiohttp.ClientError as e:
         logger.error(f"Network error: {str(e)}")
         raise Exception(f"Network error connecting to generation service: {str(e)}")
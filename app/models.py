@@ -0,0 +1,18 @@
+from dataclasses import dataclass
+
+@dataclass(frozen=True, slots=True)
+class Text2ImageRequest:
+    """Parameters for a text-to-image generation request.
+
+    Passed across the workflow/activity boundary instead of a positional
+    8-tuple: Temporal's default data converter serializes dataclasses with
+    field names, so the payload schema no longer depends on argument order.
+    """
+    prompt: str
+    model: str = "runwayml/stable-diffusion-v1-5"
+    negative_prompt: str = ""
+    width: int = 512
+    height: int = 512
+    steps: int = 30
+    cfg_scale: float = 5.0
+    seed: int | None = None
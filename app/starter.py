@@ -1,8 +1,30 @@
 import asyncio
 import argparse
+import hashlib
+import json
+import os
+import secrets
 from temporalio.client import Client
+from temporalio.common import WorkflowIDReusePolicy
+from temporalio.exceptions import WorkflowAlreadyStartedError
+from .models import Text2ImageRequest
 from .workflows import HelloWorkflow, HealthCheckWorkflow, Text2ImageWorkflow, WorkflowType
 
+# Cached Temporal client. Each Client.connect opens a fresh gRPC channel and
+# performs namespace negotiation, so callers that import this module and kick
+# off workflows in a loop should share one connection.
+_client: Client | None = None
+_client_lock = asyncio.Lock()
+
+async def get_client() -> Client:
+    """Get (or lazily create) the shared Temporal client."""
+    global _client
+    async with _client_lock:
+        if _client is None:
+            temporal_target = os.getenv("TEMPORAL_TARGET", "localhost:7233")
+            _client = await Client.connect(temporal_target)
+        return _client
+
 async def main():
     parser = argparse.ArgumentParser(description="Start Temporal workflows")
     parser.add_argument("--type", type=str, choices=[t.value for t in WorkflowType], 
@@ -33,46 +55,93 @@ async def main():
     
     args = parser.parse_args()
 
-    # Connect to the Temporal server
-    client = await Client.connect("localhost:7233")
-    
-    workflow_type = WorkflowType(args.type)
-    
-    if workflow_type == WorkflowType.HELLO:
-        # Execute HelloWorkflow
-        workflow_id = args.id or f"hello-workflow-{args.name}"
-        result = await client.execute_workflow(
-            HelloWorkflow.run,
-            args.name,
-            id=workflow_id,
-            task_queue="hello-python-tq",
-        )
-        print(f"HelloWorkflow result: {result}")
-        
-    elif workflow_type == WorkflowType.HEALTH_CHECK:
-        # Execute HealthCheckWorkflow
-        workflow_id = args.id or f"health-check-{'-'.join(args.containers)}"
-        result = await client.execute_workflow(
-            HealthCheckWorkflow.run,
-            args.containers,
-            id=workflow_id,
-            task_queue="hello-python-tq",
-        )
-        print("HealthCheckWorkflow result:")
-        print(json.dumps(result, indent=2))
-        
-    elif workflow_type == WorkflowType.TEXT2IMAGE:
-        # Execute Text2ImageWorkflow
-        workflow_id = args.id or f"text2image-{hash(args.prompt) % 10000}"
+    # Connect to the Temporal server (reusing the shared client)
+    client = await get_client()
+
+    run_fn, build_args, build_id, id_reuse_policy = WORKFLOW_DISPATCH[args.type]
+    workflow_id = args.id or build_id(args)
+
+    try:
         result = await client.execute_workflow(
-            Text2ImageWorkflow.run,
-            (args.prompt, args.model, args.negative_prompt, args.width, args.height, args.steps, args.cfg_scale, args.seed),
+            run_fn,
+            build_args(args),
             id=workflow_id,
             task_queue="hello-python-tq",
+            id_reuse_policy=id_reuse_policy,
         )
-        print("Text2ImageWorkflow result:")
-        print(json.dumps(result, indent=2))
+    except WorkflowAlreadyStartedError:
+        # With ALLOW_DUPLICATE_FAILED_ONLY a repeat of an already-successful
+        # (or still-running) workflow id is rejected at start; that IS the
+        # dedup hit, so fetch the existing run's result instead of crashing.
+        print(f"Workflow {workflow_id} already exists; fetching its result")
+        result = await client.get_workflow_handle(workflow_id).result()
+
+    print(f"{run_fn.__qualname__.split('.')[0]} result:")
+    print(json.dumps(result, indent=2))
+
+def _build_text2image_request(args) -> Text2ImageRequest:
+    return Text2ImageRequest(
+        prompt=args.prompt,
+        model=args.model,
+        negative_prompt=args.negative_prompt,
+        width=args.width,
+        height=args.height,
+        steps=args.steps,
+        cfg_scale=args.cfg_scale,
+        seed=args.seed,
+    )
+
+def _text2image_workflow_id(args) -> str:
+    # A random seed means every run is a distinct draw, so there's nothing
+    # to dedup — use a unique id (mirrors _dedup_key in the image service).
+    if args.seed is None or args.seed == -1:
+        return f"text2image-{secrets.token_hex(8)}"
+    # Stable content hash over the full parameter set: the same prompt with
+    # a different model/size/steps/cfg/seed is a different image and must
+    # not collapse onto a cached result. builtin hash() is randomized per
+    # process (PYTHONHASHSEED), so it can't dedup across runs.
+    params = json.dumps(
+        {
+            "prompt": args.prompt,
+            "negative_prompt": args.negative_prompt,
+            "model": args.model,
+            "width": args.width,
+            "height": args.height,
+            "steps": args.steps,
+            "cfg_scale": args.cfg_scale,
+            "seed": args.seed,
+        },
+        sort_keys=True,
+    )
+    digest = hashlib.blake2b(params.encode(), digest_size=8).hexdigest()
+    return f"text2image-{digest}"
+
+# Maps --type directly to (workflow run method, arg builder, default-id
+# builder, id reuse policy), replacing the if/elif chain so adding a
+# workflow type is one entry instead of another execute_workflow block.
+WORKFLOW_DISPATCH = {
+    WorkflowType.HELLO.value: (
+        HelloWorkflow.run,
+        lambda args: args.name,
+        lambda args: f"hello-workflow-{args.name}",
+        WorkflowIDReusePolicy.ALLOW_DUPLICATE,
+    ),
+    WorkflowType.HEALTH_CHECK.value: (
+        HealthCheckWorkflow.run,
+        lambda args: args.containers,
+        lambda args: f"health-check-{'-'.join(args.containers)}",
+        WorkflowIDReusePolicy.ALLOW_DUPLICATE,
+    ),
+    # Content-addressed id + dedup: re-submitting an identical prompt reuses
+    # the finished generation instead of burning another ~30s of GPU time,
+    # while a failed attempt can still be retried.
+    WorkflowType.TEXT2IMAGE.value: (
+        Text2ImageWorkflow.run,
+        _build_text2image_request,
+        _text2image_workflow_id,
+        WorkflowIDReusePolicy.ALLOW_DUPLICATE_FAILED_ONLY,
+    ),
+}
 
 if __name__ == "__main__":
-    import json
     asyncio.run(main())
\ No newline at end of file
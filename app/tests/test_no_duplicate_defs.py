@@ -0,0 +1,26 @@
+import ast
+from pathlib import Path
+
+import pytest
+
+APP_DIR = Path(__file__).resolve().parent.parent
+MODULES = sorted(APP_DIR.glob("*.py"))
+
+@pytest.mark.parametrize("module_path", MODULES, ids=lambda p: p.name)
+def test_no_duplicate_top_level_definitions(module_path):
+    """Each top-level function/class should be defined exactly once.
+
+    A duplicate definition silently shadows the earlier one at import time,
+    leaving dead code that still costs compile time and invites divergent
+    maintenance.
+    """
+    tree = ast.parse(module_path.read_text())
+
+    seen = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            assert node.name not in seen, (
+                f"{module_path.name}: '{node.name}' defined at line {node.lineno} "
+                f"shadows the definition at line {seen[node.name]}"
+            )
+            seen[node.name] = node.lineno
@@ -1,22 +1,33 @@
+import sys
+
+# Install uvloop before anything else touches asyncio: the event loop policy
+# only takes effect for loops created after it is set, so this must run
+# before temporalio/aiohttp imports. uvloop stays optional (see
+# requirements.txt) — fall back to the stdlib loop when it's missing.
+_uvloop_installed = False
+if sys.platform != "win32":
+    try:
+        import uvloop
+        uvloop.install()
+        _uvloop_installed = True
+        print("uvloop installed for better performance")
+    except ImportError:
+        print("uvloop not available, using standard event loop")
+
 import asyncio
 import os
 import signal
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from temporalio.client import Client
 from temporalio.worker import Worker
 from .workflows import HelloWorkflow, HealthCheckWorkflow, Text2ImageWorkflow
-from .activities import say_hello, check_container_health, generate_image_from_text
-
-# Try to import uvloop for better performance (optional)
-try:
-    import uvloop
-    if sys.platform != "win32":
-        uvloop.install()
-        print("uvloop installed for better performance")
-except ImportError:
-    print("uvloop not available, using standard event loop")
+from .activities import say_hello, check_container_health, check_containers_health, generate_image_from_text, close_session
 
 async def main():
+    # Guard against regressions that reorder imports and silently drop uvloop
+    if _uvloop_installed:
+        assert isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy)
+
     # Get configuration from environment variables
     temporal_target = os.getenv("TEMPORAL_TARGET", "localhost:7233")
     task_queue = os.getenv("TASK_QUEUE", "hello-python-tq")
@@ -30,6 +41,14 @@ async def main():
     # Create a worker with unrestricted sandbox for file system operations
     os.environ["TEMPORAL_SANDBOX_UNRESTRICTED"] = "1"
     
+    # Dedicated executor for synchronous/blocking activity code so it can't
+    # crowd out the long-running async image-generation activity. Sized and
+    # bounded via env vars so deployments can tune per workload.
+    activity_executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("ACTIVITY_THREADS", min(32, (os.cpu_count() or 4) * 4))),
+        thread_name_prefix="activity"
+    )
+
     worker = Worker(
         client,
         task_queue=task_queue,
@@ -41,8 +60,12 @@ async def main():
         activities=[
             say_hello,
             check_container_health,
+            check_containers_health,
             generate_image_from_text
         ],
+        activity_executor=activity_executor,
+        max_concurrent_activities=int(os.getenv("MAX_CONCURRENT_ACTIVITIES", "100")),
+        max_concurrent_workflow_tasks=int(os.getenv("MAX_CONCURRENT_WORKFLOW_TASKS", "50")),
     )
     
     print("Starting worker with unrestricted sandbox...")
@@ -65,6 +88,9 @@ async def main():
     except Exception as e:
         print(f"Worker error: {e}")
         raise
+    finally:
+        # Close the shared HTTP session used by activities
+        await close_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,12 +1,28 @@
 import asyncio
+from collections import Counter
 from enum import Enum
 from temporalio import workflow, activity
 from temporalio.common import RetryPolicy
-from .activities import say_hello, check_container_health, generate_image_from_text
+from .activities import say_hello, check_container_health, check_containers_health, generate_image_from_text
+from .models import Text2ImageRequest
 from datetime import timedelta
 
 # Note: In Temporal 1.6.0, we rely on the SandboxRestriction.UNRESTRICTED setting in worker.py
 
+# Shared immutable activity options, allocated once instead of per run —
+# thousands of concurrent workflows otherwise rebuild identical
+# RetryPolicy/timedelta objects inside the sandbox on every execution.
+_HELLO_TIMEOUT = timedelta(seconds=10)
+_HEALTH_CHECK_TIMEOUT = timedelta(seconds=30)
+_IMG_TIMEOUT = timedelta(minutes=10)
+_IMG_HEARTBEAT_TIMEOUT = timedelta(seconds=30)
+_IMG_RETRY = RetryPolicy(
+    initial_interval=timedelta(seconds=1),
+    maximum_interval=timedelta(seconds=10),
+    maximum_attempts=3,
+    non_retryable_error_types=["ValueError", "KeyError"]
+)
+
 class WorkflowType(Enum):
     HELLO = "hello"
     HEALTH_CHECK = "health_check"
@@ -24,7 +40,7 @@ class HelloWorkflow:
         return await workflow.execute_activity(
             say_hello,
             name,
-            start_to_close_timeout=timedelta(seconds=10),
+            start_to_close_timeout=_HELLO_TIMEOUT,
         )
 
     @workflow.signal
@@ -47,31 +63,29 @@ class HealthCheckWorkflow:
     @workflow.run
     async def run(self, containers: list[str]) -> dict:
         self._containers = containers
-        health_results = {}
-        
-        # Check health of all containers in parallel
-        tasks = []
-        for container in containers:
-            task = workflow.execute_activity(
-                check_container_health,
-                container,
-                start_to_close_timeout=timedelta(seconds=30),
-            )
-            tasks.append(task)
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for i, container in enumerate(containers):
-            if isinstance(results[i], Exception):
-                health_results[container] = {
+
+        # Check all containers in parallel, recording each result as it
+        # lands so get_health_status queries see partial progress while a
+        # slow container is still being inspected. The per-container
+        # activity is cheap now that inspects share the Docker socket
+        # session and TTL cache.
+        async def _check(container: str):
+            try:
+                result = await workflow.execute_activity(
+                    check_container_health,
+                    container,
+                    start_to_close_timeout=_HEALTH_CHECK_TIMEOUT,
+                )
+            except Exception as e:
+                result = {
                     "status": "error",
-                    "error": str(results[i])
+                    "error": str(e)
                 }
-            else:
-                health_results[container] = results[i]
-        
-        self._health_results = health_results
-        return health_results
+            self._health_results[container] = result
+
+        await asyncio.gather(*(_check(container) for container in containers))
+
+        return self._health_results
 
     @workflow.signal
     def add_container(self, container: str):
@@ -90,22 +104,17 @@ class HealthCheckWorkflow:
 
     def _get_health_summary(self) -> dict:
         """Calculate health summary statistics."""
-        if not self._health_results:
-            return {"total": 0, "healthy": 0, "unhealthy": 0, "errors": 0}
-        
-        total = len(self._health_results)
-        healthy = sum(1 for result in self._health_results.values() 
-                     if result.get("status") == "healthy")
-        unhealthy = sum(1 for result in self._health_results.values() 
-                       if result.get("status") == "unhealthy")
-        errors = sum(1 for result in self._health_results.values() 
-                    if result.get("status") == "error")
-        
+        # Single pass over the results; queries are replayed on workflow
+        # history restoration, so this runs far more often than it looks.
+        counts = Counter(
+            result.get("status") for result in self._health_results.values()
+        )
+
         return {
-            "total": total,
-            "healthy": healthy,
-            "unhealthy": unhealthy,
-            "errors": errors
+            "total": len(self._health_results),
+            "healthy": counts["healthy"],
+            "unhealthy": counts["unhealthy"],
+            "errors": counts["error"]
         }
 
 @workflow.defn
@@ -117,32 +126,49 @@ class Text2ImageWorkflow:
         self._progress = 0
 
     @workflow.run
-    async def run(self, args: tuple) -> dict:
+    async def run(self, request: Text2ImageRequest) -> dict:
         """
         Generate an image from text using the specified model.
-        
+
         Args:
-            args: Tuple containing (prompt, model, negative_prompt, width, height, steps, cfg_scale, seed)
-            
+            request: Text2ImageRequest with the generation parameters
+
         Returns:
             Dictionary containing the generation result
         """
-        # Unpack the arguments
-        prompt, model, negative_prompt, width, height, steps, cfg_scale, seed = args
-        
+        self._prompt = request.prompt
+        self._status = "generating"
+
         # Execute the image generation activity with retry policy
-        retry_policy = RetryPolicy(
-            initial_interval=timedelta(seconds=1),
-            maximum_interval=timedelta(seconds=10),
-            maximum_attempts=3,
-            non_retryable_error_types=["ValueError", "KeyError"]
-        )
-        
         result = await workflow.execute_activity(
             generate_image_from_text,
-            args,
-            start_to_close_timeout=timedelta(minutes=10),
-            retry_policy=retry_policy,
+            request,
+            start_to_close_timeout=_IMG_TIMEOUT,
+            heartbeat_timeout=_IMG_HEARTBEAT_TIMEOUT,
+            retry_policy=_IMG_RETRY,
         )
-        
-        return result
\ No newline at end of file
+
+        self._status = "completed"
+        self._progress = 100
+        self._image_url = result.get("image_url")
+        return result
+
+    @workflow.signal
+    def update_progress(self, progress: int):
+        """Update generation progress (clamped to 0-100)."""
+        self._progress = max(0, min(100, progress))
+
+    @workflow.signal
+    def cancel_generation(self):
+        """Mark the generation as cancelled."""
+        self._status = "cancelled"
+
+    @workflow.query
+    def get_status(self) -> dict:
+        """Get the current generation status."""
+        return {
+            "prompt": self._prompt,
+            "status": self._status,
+            "progress": self._progress,
+            "image_url": self._image_url,
+        }
\ No newline at end of file
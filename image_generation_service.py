@@ -1,567 +1,1174 @@
-#!/usr/bin/env python3
-"""
-Image Generation Microservice
-Runs Stable Diffusion models locally on GPU using ComfyUI model structure
-"""
-
-import asyncio
-import base64
-import json
-import logging
-import os
-import time
-import uuid
-from datetime import datetime
-from pathlib import Path
-from typing import Dict, Optional, List
-
-import aiofiles
-import torch
-import torch.serialization
-import uvicorn
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
-from diffusers.pipelines.stable_diffusion.convert_from_ckpt import download_from_original_stable_diffusion_ckpt
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-# Global variables
-app = FastAPI(title="Image Generation Service", version="1.0.0")
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
-
-pipeline = None
-models_cache = {}
-tasks = {}
-
-# ComfyUI models directory - adjust this to your ComfyUI models path
-COMFYUI_MODELS_DIR = os.getenv("COMFYUI_MODELS_DIR", "/mnt/c/Users/jeric/Documents/ComfyUI/models")
-OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./generated_images")
-
-# Ensure output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-class GenerationRequest(BaseModel):
-    prompt: str
-    negative_prompt: str = ""
-    model: str = "stable-diffusion-v1-5"
-    width: int = 512
-    height: int = 512
-    steps: int = 20
-    cfg_scale: float = 7.5
-    seed: int = -1
-    sampler: str = "euler"
-    scheduler: str = "normal"
-
-class GenerationTask:
-    def __init__(self, task_id: str, request: GenerationRequest):
-        self.task_id = task_id
-        self.request = request
-        self.status = "pending"
-        self.progress = 0
-        self.result = None
-        self.error = None
-        self.start_time = None
-        self.end_time = None
-
-def get_available_models() -> Dict[str, List[str]]:
-    """Get list of available models from the ComfyUI models directory."""
-    models = {
-        "checkpoints": [],
-        "loras": [],
-        "controlnet": [],
-        "vae": [],
-        "embeddings": [],
-        "upscale_models": []
-    }
-    
-    if not os.path.exists(COMFYUI_MODELS_DIR):
-        logger.warning(f"ComfyUI models directory not found: {COMFYUI_MODELS_DIR}")
-        return models
-    
-    # Checkpoints (main models)
-    checkpoints_dir = os.path.join(COMFYUI_MODELS_DIR, "checkpoints")
-    if os.path.exists(checkpoints_dir):
-        # First, scan files directly in the checkpoints directory
-        for file in os.listdir(checkpoints_dir):
-            file_path = os.path.join(checkpoints_dir, file)
-            if os.path.isfile(file_path) and file.endswith(('.safetensors', '.ckpt', '.bin')):
-                models["checkpoints"].append(file)
-        
-        # Then scan subdirectories
-        for subdir in os.listdir(checkpoints_dir):
-            subdir_path = os.path.join(checkpoints_dir, subdir)
-            if os.path.isdir(subdir_path):
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.ckpt', '.bin')):
-                        models["checkpoints"].append(f"{subdir}/{file}")
-    
-    # LoRAs
-    loras_dir = os.path.join(COMFYUI_MODELS_DIR, "loras")
-    if os.path.exists(loras_dir):
-        for subdir in os.listdir(loras_dir):
-            subdir_path = os.path.join(loras_dir, subdir)
-            if os.path.isdir(subdir_path):
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.ckpt')):
-                        models["loras"].append(f"{subdir}/{file}")
-    
-    # ControlNet models
-    controlnet_dir = os.path.join(COMFYUI_MODELS_DIR, "controlnet")
-    if os.path.exists(controlnet_dir):
-        for subdir in os.listdir(controlnet_dir):
-            subdir_path = os.path.join(controlnet_dir, subdir)
-            if os.path.isdir(subdir_path):
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.ckpt')):
-                        models["controlnet"].append(f"{subdir}/{file}")
-    
-    # VAE models
-    vae_dir = os.path.join(COMFYUI_MODELS_DIR, "vae")
-    if os.path.exists(vae_dir):
-        for subdir in os.listdir(vae_dir):
-            subdir_path = os.path.join(vae_dir, subdir)
-            if os.path.isdir(subdir_path):
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.ckpt')):
-                        models["vae"].append(f"{subdir}/{file}")
-    
-    # Embeddings
-    embeddings_dir = os.path.join(COMFYUI_MODELS_DIR, "embeddings")
-    if os.path.exists(embeddings_dir):
-        for subdir in os.listdir(embeddings_dir):
-            subdir_path = os.path.join(embeddings_dir, subdir)
-            if os.path.isdir(subdir_path):
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.bin')):
-                        models["embeddings"].append(f"{subdir}/{file}")
-    
-    # Upscale models
-    upscale_dir = os.path.join(COMFYUI_MODELS_DIR, "upscale_models")
-    if os.path.exists(upscale_dir):
-        for file in os.listdir(upscale_dir):
-            if file.endswith(('.safetensors', '.ckpt', '.pth')):
-                models["upscale_models"].append(file)
-    
-    return models
-
-def find_model_path(model_name: str) -> Optional[str]:
-    """Find the full path to a model in the ComfyUI directory structure."""
-    if not os.path.exists(COMFYUI_MODELS_DIR):
-        return None
-    
-    logger.info(f"Looking for model: {model_name}")
-    
-    # Check if it's a path with subdirectory (e.g., "SD1.5/v1-5-pruned-emaonly.ckpt")
-    if "/" in model_name:
-        # Check in checkpoints directory first
-        checkpoints_dir = os.path.join(COMFYUI_MODELS_DIR, "checkpoints")
-        if os.path.exists(checkpoints_dir):
-            model_path = os.path.join(checkpoints_dir, model_name)
-            if os.path.exists(model_path):
-                logger.info(f"Found model at: {model_path}")
-                return model_path
-        
-        # Check if it's a direct path in the models directory
-        direct_path = os.path.join(COMFYUI_MODELS_DIR, model_name)
-        if os.path.exists(direct_path):
-            logger.info(f"Found model at: {direct_path}")
-            return direct_path
-        
-        # If not found locally, return as-is for HuggingFace models
-        logger.info(f"Model not found locally, treating as HuggingFace model: {model_name}")
-        return model_name
-    
-    # For simple model names, search in checkpoints directory
-    checkpoints_dir = os.path.join(COMFYUI_MODELS_DIR, "checkpoints")
-    if os.path.exists(checkpoints_dir):
-        # First, check files directly in checkpoints directory
-        for file in os.listdir(checkpoints_dir):
-            file_path = os.path.join(checkpoints_dir, file)
-            if os.path.isfile(file_path) and file.endswith(('.safetensors', '.ckpt', '.bin')):
-                if file == model_name or file.startswith(model_name):
-                    logger.info(f"Found model at: {file_path}")
-                    return file_path
-        
-        # Then check subdirectories
-        for subdir in os.listdir(checkpoints_dir):
-            subdir_path = os.path.join(checkpoints_dir, subdir)
-            if os.path.isdir(subdir_path):
-                # Check for exact match
-                model_path = os.path.join(subdir_path, model_name)
-                if os.path.exists(model_path):
-                    logger.info(f"Found model at: {model_path}")
-                    return model_path
-                
-                # Check for match without extension
-                for file in os.listdir(subdir_path):
-                    if file.endswith(('.safetensors', '.ckpt', '.bin')):
-                        if file == model_name or file.startswith(model_name):
-                            found_path = os.path.join(subdir_path, file)
-                            logger.info(f"Found model at: {found_path}")
-                            return found_path
-    
-    # Check if it's a direct path
-    direct_path = os.path.join(COMFYUI_MODELS_DIR, model_name)
-    if os.path.exists(direct_path):
-        logger.info(f"Found model at: {direct_path}")
-        return direct_path
-    
-    logger.warning(f"Model not found: {model_name}")
-    return None
-
-def load_model(model_name: str):
-    """Load a Stable Diffusion model from ComfyUI directory."""
-    global pipeline, models_cache
-    
-    if model_name in models_cache:
-        return models_cache[model_name]
-    
-    # Find the model path
-    model_path = find_model_path(model_name)
-    if not model_path:
-        # Try to load from HuggingFace hub
-        model_path = model_name
-    
-    try:
-        logger.info(f"Loading model: {model_path}")
-        
-        # Check if it's a .ckpt file
-        if model_path.endswith('.ckpt'):
-            logger.info(f"Converting checkpoint file: {model_path}")
-            # Convert checkpoint to diffusers format with safe globals
-            with torch.serialization.safe_globals(['pytorch_lightning.callbacks.model_checkpoint.ModelCheckpoint']):
-                pipeline = download_from_original_stable_diffusion_ckpt(
-                    checkpoint_path_or_dict=model_path,
-                    from_safetensors=False,
-                    load_safety_checker=False,
-                    extract_ema=True,
-                    device="cuda" if torch.cuda.is_available() else "cpu",
-                    local_files_only=True
-                )
-        elif model_path.endswith('.safetensors'):
-            logger.info(f"Converting safetensors file: {model_path}")
-            # Convert safetensors to diffusers format
-            with torch.serialization.safe_globals(['pytorch_lightning.callbacks.model_checkpoint.ModelCheckpoint']):
-                pipeline = download_from_original_stable_diffusion_ckpt(
-                    checkpoint_path_or_dict=model_path,
-                    from_safetensors=True,
-                    load_safety_checker=False,
-                    extract_ema=True,
-                    device="cuda" if torch.cuda.is_available() else "cpu",
-                    local_files_only=True
-                )
-        else:
-            # Try to load from HuggingFace hub or local path
-            try:
-                pipeline = StableDiffusionPipeline.from_pretrained(
-                    model_path,
-                    torch_dtype=torch.float32,
-                    safety_checker=None,
-                    requires_safety_checker=False
-                )
-            except Exception as hf_error:
-                logger.warning(f"Failed to load from HuggingFace: {hf_error}")
-                # Fallback to a known working model
-                logger.info("Falling back to stable-diffusion-v1-5")
-                pipeline = StableDiffusionPipeline.from_pretrained(
-                    "runwayml/stable-diffusion-v1-5",
-                    torch_dtype=torch.float32,
-                    safety_checker=None,
-                    requires_safety_checker=False
-                )
-        
-        # Move to GPU if available
-        if torch.cuda.is_available():
-            pipeline = pipeline.to("cuda")
-            logger.info("Model loaded on GPU")
-        else:
-            logger.info("Model loaded on CPU")
-        
-        # Set scheduler
-        pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
-        
-        models_cache[model_name] = pipeline
-        return pipeline
-        
-    except Exception as e:
-        logger.error(f"Failed to load model {model_name}: {str(e)}")
-        # Fallback to a known working model
-        logger.info("Falling back to stable-diffusion-v1-5")
-        try:
-            pipeline = StableDiffusionPipeline.from_pretrained(
-                "runwayml/stable-diffusion-v1-5",
-                torch_dtype=torch.float32,
-                safety_checker=None,
-                requires_safety_checker=False
-            )
-            if torch.cuda.is_available():
-                pipeline = pipeline.to("cuda")
-            pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
-            models_cache[model_name] = pipeline
-            return pipeline
-        except Exception as fallback_error:
-            logger.error(f"Fallback model also failed: {fallback_error}")
-            raise
-
-async def generate_image_task(task: GenerationTask):
-    """Background task to generate an image."""
-    global pipeline
-    
-    try:
-        task.status = "processing"
-        task.start_time = time.time()
-        
-        # Set seed first (before any model loading)
-        if task.request.seed == -1:
-            seed = torch.randint(0, 2**32 - 1, (1,)).item()
-        else:
-            seed = task.request.seed
-        
-        # Set the seed globally for reproducibility
-        torch.manual_seed(seed)
-        if torch.cuda.is_available():
-            torch.cuda.manual_seed(seed)
-            torch.cuda.manual_seed_all(seed)
-        
-        logger.info(f"Using seed: {seed} for task {task.task_id}")
-        
-        # Load model if not already loaded
-        pipeline = load_model(task.request.model)
-        
-        # Generate image
-        logger.info(f"Generating image for task {task.task_id} with model: {task.request.model}")
-        
-        # Create generator with the specific seed
-        generator = torch.Generator(device=pipeline.device).manual_seed(seed)
-        
-        with torch.no_grad():
-            result = pipeline(
-                prompt=task.request.prompt,
-                negative_prompt=task.request.negative_prompt,
-                width=task.request.width,
-                height=task.request.height,
-                num_inference_steps=task.request.steps,
-                guidance_scale=task.request.cfg_scale,
-                generator=generator
-            )
-        
-        # Save image
-        image = result.images[0]
-        image_filename = f"{task.task_id}.png"
-        image_path = os.path.join(OUTPUT_DIR, image_filename)
-        image.save(image_path)
-        
-        # Convert to base64 for API response
-        import io
-        img_buffer = io.BytesIO()
-        image.save(img_buffer, format='PNG')
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode()
-        
-        task.end_time = time.time()
-        task.status = "completed"
-        task.progress = 100
-        
-        task.result = {
-            "image_url": f"/images/{image_filename}",
-            "image_data": img_base64,
-            "generation_time": f"{task.end_time - task.start_time:.2f}s",
-            "model_version": task.request.model,
-            "seed": seed,
-            "actual_model_used": pipeline.__class__.__name__
-        }
-        
-        logger.info(f"Image generation completed for task {task.task_id} with seed {seed}")
-        
-    except Exception as e:
-        task.status = "failed"
-        task.error = str(e)
-        logger.error(f"Image generation failed for task {task.task_id}: {str(e)}")
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize the service on startup."""
-    logger.info("Starting Image Generation Service")
-    logger.info(f"ComfyUI models directory: {COMFYUI_MODELS_DIR}")
-    logger.info(f"Output directory: {OUTPUT_DIR}")
-    
-    # Check for available models
-    models = get_available_models()
-    total_models = sum(len(model_list) for model_list in models.values())
-    logger.info(f"Found {total_models} models in ComfyUI directory")
-    
-    # Log model counts by type
-    for model_type, model_list in models.items():
-        if model_list:
-            logger.info(f"  {model_type}: {len(model_list)} models")
-    
-    # Check GPU availability
-    if torch.cuda.is_available():
-        logger.info(f"GPU available: {torch.cuda.get_device_name(0)}")
-        logger.info(f"GPU memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
-    else:
-        logger.warning("No GPU available, using CPU")
-
-@app.get("/")
-async def root():
-    """Health check endpoint."""
-    models = get_available_models()
-    total_models = sum(len(model_list) for model_list in models.values())
-    
-    return {
-        "service": "Image Generation Service",
-        "status": "running",
-        "gpu_available": torch.cuda.is_available(),
-        "models_loaded": list(models_cache.keys()),
-        "total_models_found": total_models,
-        "comfyui_models_dir": COMFYUI_MODELS_DIR
-    }
-
-@app.get("/models")
-async def list_models():
-    """List available models from ComfyUI directory."""
-    models = get_available_models()
-    return {
-        "available_models": models,
-        "loaded_models": list(models_cache.keys()),
-        "comfyui_models_dir": COMFYUI_MODELS_DIR
-    }
-
-@app.get("/models/checkpoints")
-async def list_checkpoints():
-    """List available checkpoint models."""
-    models = get_available_models()
-    return {
-        "checkpoints": models["checkpoints"],
-        "total": len(models["checkpoints"])
-    }
-
-@app.get("/models/text2image")
-async def list_text2image_models():
-    """List all models capable of text-to-image generation."""
-    models = get_available_models()
-    
-    # Filter for text-to-image capable models
-    text2image_models = []
-    
-    # Add all checkpoint models (main text-to-image models)
-    for model in models["checkpoints"]:
-        text2image_models.append({
-            "name": model,
-            "type": "checkpoint",
-            "category": "main"
-        })
-    
-    # Add LoRA models that can be used for text-to-image
-    for model in models["loras"]:
-        # Include useful LoRAs for text-to-image generation
-        if any(keyword in model.lower() for keyword in [
-            "dmd2", "lightning", "faceid", "contrast", "offset", "vega", 
-            "realistic", "real", "photorealistic", "photo", "anime", 
-            "cartoon", "art", "style", "enhance", "improve", "hyper",
-            "lcm", "realism", "mjv6"
-        ]):
-            text2image_models.append({
-                "name": model,
-                "type": "lora",
-                "category": "style"
-            })
-    
-    return {
-        "models": text2image_models,
-        "total": len(text2image_models),
-        "categories": {
-            "checkpoints": len([m for m in text2image_models if m["type"] == "checkpoint"]),
-            "loras": len([m for m in text2image_models if m["type"] == "lora"])
-        }
-    }
-
-@app.post("/generate")
-async def generate_image(request: GenerationRequest, background_tasks: BackgroundTasks):
-    """Start an image generation task."""
-    task_id = str(uuid.uuid4())
-    task = GenerationTask(task_id, request)
-    tasks[task_id] = task
-    
-    # Start background task
-    background_tasks.add_task(generate_image_task, task)
-    
-    logger.info(f"Started generation task {task_id} for prompt: {request.prompt[:50]}...")
-    
-    return {
-        "task_id": task_id,
-        "status": "started",
-        "message": "Image generation started"
-    }
-
-@app.get("/status/{task_id}")
-async def get_status(task_id: str):
-    """Get the status of a generation task."""
-    if task_id not in tasks:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = tasks[task_id]
-    return {
-        "task_id": task_id,
-        "status": task.status,
-        "progress": task.progress,
-        "error": task.error
-    }
-
-@app.get("/result/{task_id}")
-async def get_result(task_id: str):
-    """Get the result of a completed generation task."""
-    if task_id not in tasks:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = tasks[task_id]
-    
-    if task.status == "completed":
-        return task.result
-    elif task.status == "failed":
-        raise HTTPException(status_code=400, detail=f"Generation failed: {task.error}")
-    else:
-        raise HTTPException(status_code=202, detail="Task still processing")
-
-@app.get("/images/{filename}")
-async def get_image(filename: str):
-    """Serve generated images."""
-    image_path = os.path.join(OUTPUT_DIR, filename)
-    if not os.path.exists(image_path):
-        raise HTTPException(status_code=404, detail="Image not found")
-    
-    from fastapi.responses import FileResponse
-    return FileResponse(image_path)
-
-@app.delete("/tasks/{task_id}")
-async def cancel_task(task_id: str):
-    """Cancel a generation task."""
-    if task_id not in tasks:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    task = tasks[task_id]
-    if task.status in ["pending", "processing"]:
-        task.status = "cancelled"
-        return {"message": "Task cancelled"}
-    else:
-        raise HTTPException(status_code=400, detail="Cannot cancel completed or failed task")
-
-if __name__ == "__main__":
-    # Get configuration from environment
-    host = os.getenv("HOST", "0.0.0.0")
-    port = int(os.getenv("PORT", "8001"))
-    
-    logger.info(f"Starting server on {host}:{port}")
-    uvicorn.run(app, host=host, port=port) 
\ No newline at end of file
+#!/usr/bin/env python3
+"""
+Image Generation Microservice
+Runs Stable Diffusion models locally on GPU using ComfyUI model structure
+"""
+
+import asyncio
+import base64
+import functools
+import gc
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, List
+
+import aiofiles
+import torch
+import torch.serialization
+import uvicorn
+from diffusers import (
+    StableDiffusionPipeline,
+    DPMSolverMultistepScheduler,
+    EulerDiscreteScheduler,
+    EulerAncestralDiscreteScheduler,
+    LCMScheduler,
+)
+from diffusers.pipelines.stable_diffusion.convert_from_ckpt import download_from_original_stable_diffusion_ckpt
+from fastapi import FastAPI, HTTPException, BackgroundTasks
+from PIL import Image
+from fastapi.responses import JSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# orjson serializes large base64 payloads several times faster than the
+# stdlib encoder; fall back silently when it isn't installed
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse
+    _default_response_class = ORJSONResponse
+except ImportError:
+    _default_response_class = JSONResponse
+
+# Global variables
+app = FastAPI(
+    title="Image Generation Service",
+    version="1.0.0",
+    default_response_class=_default_response_class,
+)
+
+# Add CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allows all origins
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+)
+
+# LRU of loaded pipelines: every entry pins a full pipeline's worth of
+# VRAM, so the cache is bounded by entry count and by free GPU memory
+models_cache: "OrderedDict[str, StableDiffusionPipeline]" = OrderedDict()
+
+# Insertion-ordered task store, pruned by size and age on insert so a
+# long-running service doesn't accumulate finished tasks (and their
+# inline base64 payloads) forever
+tasks: "OrderedDict[str, GenerationTask]" = OrderedDict()
+TASK_CACHE_MAX = int(os.getenv("TASK_CACHE_MAX", "1024"))
+TASK_CACHE_TTL = int(os.getenv("TASK_CACHE_TTL", "3600"))
+
+MAX_CACHED_MODELS = int(os.getenv("MAX_CACHED_MODELS", "2"))
+MIN_FREE_GPU_BYTES = int(float(os.getenv("MIN_FREE_GPU_GB", "1.0")) * 1024**3)
+
+# LRU of CLIP text embeddings keyed by (model, prompt, negative_prompt):
+# repeat prompts skip the tokenizer + text encoder entirely. Each SD1.5
+# entry is ~300KB, so 128 entries stay well under 50MB.
+_emb_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+MAX_CACHED_EMBEDS = int(os.getenv("MAX_CACHED_EMBEDS", "128"))
+
+# One RNG per device, reseeded per request; allocating a fresh
+# torch.Generator every call is pure overhead
+_generators: dict = {}
+
+# Pinned host buffers for the VAE-output D2H copy, one per image shape;
+# pageable copies stall on the PCIe transfer, pinned ones don't
+_pinned_buffers: dict = {}
+
+# Serialize loads so concurrent requests for the same model don't both
+# spend 10+ seconds loading it
+_load_lock = threading.Lock()
+
+# One generation on the GPU at a time: concurrent pipelines thrash the GPU
+# context and each runs slower than they would back to back. Raise only on
+# multi-GPU hosts.
+GPU_SEM = asyncio.Semaphore(int(os.getenv("GPU_CONCURRENCY", "1")))
+
+# Dedicated pool for PIL encode/save work, sized to the machine, so image
+# encoding parallelizes across cores without contending with asyncio's
+# shared default executor
+_pil_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="pil")
+
+async def _run_pil(func, *args, **kwargs):
+    """Run blocking PIL work on the dedicated image pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pil_pool, functools.partial(func, *args, **kwargs))
+
+# ComfyUI models directory - adjust this to your ComfyUI models path
+COMFYUI_MODELS_DIR = os.getenv("COMFYUI_MODELS_DIR", "/mnt/c/Users/jeric/Documents/ComfyUI/models")
+OUTPUT_DIR = os.getenv("OUTPUT_DIR", "./generated_images")
+
+# Compile the UNet with torch.compile for ~1.2-2x faster denoising. Off by
+# default because the first generation per model pays a ~60-80s warmup.
+COMPILE_UNET = os.getenv("COMPILE_UNET", "0") == "1"
+
+# "torch" (inductor) or "tensorrt" (requires torch_tensorrt); TRT builds
+# fixed-shape fused engines that can beat inductor on RTX-class GPUs
+COMPILE_BACKEND = os.getenv("COMPILE_BACKEND", "torch")
+
+# Half precision on GPU: ~2x UNet throughput and half the VRAM. CPU stays
+# at float32 since fp16 is slow there.
+TORCH_DTYPE = torch.float16 if torch.cuda.is_available() else torch.float32
+
+# Optional weight-only quantization ("int8_weight_only" via torchao).
+# Cuts UNet/text-encoder VRAM by ~40-60% so several checkpoints can stay
+# hot in models_cache on an 8-12GB GPU, at a small dequant cost per step.
+QUANTIZE = os.getenv("QUANTIZE", "none")
+
+# Ensure output directory exists
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Completed-task checkpoints; rehydrated into the task store on startup
+TASKS_DIR = os.path.join(OUTPUT_DIR, "tasks")
+os.makedirs(TASKS_DIR, exist_ok=True)
+
+# Request-time sampler switching: maps the request's sampler string to
+# (scheduler class, from_config kwargs), built once so dispatch is a dict
+# hit. "dpm++" carries its SDE/Karras configuration here because those
+# kwargs don't survive a bare from_config round trip through another
+# scheduler class's config.
+SAMPLER_CLASSES = {
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "lcm": (LCMScheduler, {}),
+    "dpm++": (
+        DPMSolverMultistepScheduler,
+        {
+            "use_karras_sigmas": True,
+            "algorithm_type": "sde-dpmsolver++",
+            "solver_order": 2,
+        },
+    ),
+}
+
+# Output formats: extension, MIME type, PIL save kwargs. WebP is the
+# default because PNG's single-threaded deflate costs 100-300ms per
+# 1024^2 image; lossy q90 WebP encodes 5-20x faster and is 3-10x smaller.
+IMAGE_FORMATS = {
+    "webp": (".webp", "image/webp", {"quality": 90, "method": 4}),
+    "jpeg": (".jpg", "image/jpeg", {"quality": 90}),
+    "png": (".png", "image/png", {"compress_level": 1}),
+}
+_MIME_BY_EXT = {ext: mime for ext, mime, _ in IMAGE_FORMATS.values()}
+
+class GenerationRequest(BaseModel):
+    # extra=ignore skips validating unknown fields; frozen lets requests
+    # be safely shared between tasks (and hashed for dedup) once parsed
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    prompt: str = Field(min_length=1, max_length=2000)
+    negative_prompt: str = Field("", max_length=2000)
+    model: str = "stable-diffusion-v1-5"
+    width: int = Field(512, ge=64, le=2048, multiple_of=8)
+    height: int = Field(512, ge=64, le=2048, multiple_of=8)
+    # The SDE-DPM++ Karras solver converges around 8 steps; wall clock
+    # scales linearly with steps, so the old default of 20 was ~2.5x slower
+    steps: int = Field(8, ge=1, le=150)
+    cfg_scale: float = Field(7.5, ge=0.0, le=30.0)
+    seed: int = -1
+    sampler: str = "dpm++"
+    scheduler: str = "normal"
+    # Inline base64 in the task result; most clients only need image_url,
+    # and get_result can still produce base64 on demand
+    return_base64: bool = False
+    # Tile the VAE decode; enabled automatically for large outputs
+    vae_tiling: bool = False
+    # "webp", "jpeg" or "png"; see IMAGE_FORMATS
+    format: str = "webp"
+
+class GenerationTask:
+    def __init__(self, task_id: str, request: GenerationRequest):
+        self.task_id = task_id
+        self.request = request
+        self.status = "pending"
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.created_at = time.time()
+        self.dedup_key = None
+
+# model type -> (extensions, scan files in the top directory, scan subdirs).
+# Mirrors the ComfyUI layout: checkpoints live flat and in subdirs, the
+# other model types in subdirs only, upscale models flat only.
+_MODEL_DIR_SPECS = {
+    "checkpoints": (('.safetensors', '.ckpt', '.bin'), True, True),
+    "loras": (('.safetensors', '.ckpt'), False, True),
+    "controlnet": (('.safetensors', '.ckpt'), False, True),
+    "vae": (('.safetensors', '.ckpt'), False, True),
+    "embeddings": (('.safetensors', '.bin'), False, True),
+    "upscale_models": (('.safetensors', '.ckpt', '.pth'), True, False),
+}
+
+# Directory-scan memo, invalidated by mtime signature. The signature
+# itself costs a few dozen stat calls — expensive across the WSL /mnt/c
+# boundary — so it is only recomputed after MODELS_CACHE_TTL seconds.
+_models_signature = None
+_models_snapshot = None
+_models_checked_at = 0.0
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "30"))
+
+# Checkpoint lookup index built by the same scan: maps file name,
+# subdir/file name, and extension-less stem to the absolute path so
+# find_model_path is a dict hit instead of nested directory walks.
+_model_index: Dict[str, str] = {}
+
+def _models_dir_signature() -> tuple:
+    """Cheap change signature for the model directories.
+
+    Stats each model-type directory and its immediate subdirectories —
+    adding or removing a model file bumps the mtime of its parent, so this
+    catches changes at both nesting levels for a handful of stat calls.
+    """
+    sig = []
+    for model_type in _MODEL_DIR_SPECS:
+        dir_path = os.path.join(COMFYUI_MODELS_DIR, model_type)
+        try:
+            sig.append((dir_path, os.stat(dir_path).st_mtime_ns))
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        sig.append((entry.path, entry.stat(follow_symlinks=False).st_mtime_ns))
+        except OSError:
+            sig.append((dir_path, None))
+    return tuple(sig)
+
+def _index_checkpoint(index: Dict[str, str], name: str, rel_name: str, path: str):
+    """Register lookup keys for a checkpoint file (first hit wins)."""
+    index.setdefault(name, path)
+    index.setdefault(rel_name, path)
+    index.setdefault(os.path.splitext(name)[0], path)
+
+def _scan_model_type(model_type: str, extensions, scan_flat, scan_subdirs):
+    """Scan one model-type directory; returns (names, index fragment)."""
+    found: List[str] = []
+    index: Dict[str, str] = {}
+
+    dir_path = os.path.join(COMFYUI_MODELS_DIR, model_type)
+    if not os.path.isdir(dir_path):
+        return found, index
+
+    # scandir reads file type with the directory entry, avoiding the
+    # per-file stat that os.listdir + os.path.isfile costs
+    subdirs = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                if scan_flat and entry.name.endswith(extensions):
+                    found.append(entry.name)
+                    if model_type == "checkpoints":
+                        _index_checkpoint(index, entry.name, entry.name, entry.path)
+            elif scan_subdirs and entry.is_dir(follow_symlinks=False):
+                subdirs.append((entry.name, entry.path))
+
+    for subdir_name, subdir_path in subdirs:
+        with os.scandir(subdir_path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.name.endswith(extensions):
+                    rel_name = f"{subdir_name}/{entry.name}"
+                    found.append(rel_name)
+                    if model_type == "checkpoints":
+                        _index_checkpoint(index, entry.name, rel_name, entry.path)
+
+    return found, index
+
+def _scan_models() -> Dict[str, List[str]]:
+    """Scan the ComfyUI models directory for model files.
+
+    The six model-type directories are scanned concurrently; the scans
+    are pure I/O (stat releases the GIL), so a cold page cache costs one
+    directory's worth of latency instead of six.
+    """
+    global _model_index
+    models = {model_type: [] for model_type in _MODEL_DIR_SPECS}
+    index: Dict[str, str] = {}
+
+    if not os.path.exists(COMFYUI_MODELS_DIR):
+        logger.warning(f"ComfyUI models directory not found: {COMFYUI_MODELS_DIR}")
+        _model_index = index
+        return models
+
+    with ThreadPoolExecutor(max_workers=len(_MODEL_DIR_SPECS)) as executor:
+        futures = {
+            model_type: executor.submit(_scan_model_type, model_type, *spec)
+            for model_type, spec in _MODEL_DIR_SPECS.items()
+        }
+        for model_type, future in futures.items():
+            found, fragment = future.result()
+            models[model_type] = found
+            for key, path in fragment.items():
+                index.setdefault(key, path)
+
+    _model_index = index
+    return models
+
+def get_available_models() -> Dict[str, List[str]]:
+    """Get list of available models from the ComfyUI models directory.
+
+    The scan result is memoized against a directory-mtime signature, and
+    the signature check itself is rate-limited to once per
+    MODELS_CACHE_TTL seconds, so model-list endpoints under load cost a
+    dict return rather than stat calls or a rescan.
+    """
+    global _models_signature, _models_snapshot, _models_checked_at
+
+    now = time.monotonic()
+    if _models_snapshot is not None and now - _models_checked_at < MODELS_CACHE_TTL:
+        return _models_snapshot
+
+    signature = _models_dir_signature()
+    if _models_snapshot is None or signature != _models_signature:
+        _models_snapshot = _scan_models()
+        _models_signature = signature
+    _models_checked_at = now
+    return _models_snapshot
+
+def find_model_path(model_name: str) -> Optional[str]:
+    """Find the full path to a model in the ComfyUI directory structure.
+
+    Resolution is an O(1) hit against the checkpoint index built by the
+    directory scan (refreshed automatically when the directories change),
+    with a prefix pass over the in-memory keys preserving the old
+    "v1-5 matches v1-5-pruned.ckpt" behavior.
+    """
+    if not os.path.exists(COMFYUI_MODELS_DIR):
+        return None
+
+    logger.info(f"Looking for model: {model_name}")
+
+    # Refresh the index if the model directories changed
+    get_available_models()
+
+    model_path = _model_index.get(model_name)
+    if model_path:
+        logger.info(f"Found model at: {model_path}")
+        return model_path
+
+    # Path with subdirectory (e.g., "SD1.5/v1-5-pruned-emaonly.ckpt")
+    if "/" in model_name:
+        # Check if it's a direct path in the models directory
+        direct_path = os.path.join(COMFYUI_MODELS_DIR, model_name)
+        if os.path.exists(direct_path):
+            logger.info(f"Found model at: {direct_path}")
+            return direct_path
+
+        # If not found locally, return as-is for HuggingFace models
+        logger.info(f"Model not found locally, treating as HuggingFace model: {model_name}")
+        return model_name
+
+    # Prefix match against indexed file names (no directory I/O)
+    for key, path in _model_index.items():
+        if "/" not in key and key.startswith(model_name):
+            logger.info(f"Found model at: {path}")
+            return path
+
+    # Check if it's a direct path
+    direct_path = os.path.join(COMFYUI_MODELS_DIR, model_name)
+    if os.path.exists(direct_path):
+        logger.info(f"Found model at: {direct_path}")
+        return direct_path
+
+    logger.warning(f"Model not found: {model_name}")
+    return None
+
+def _quantize_pipeline(pipeline):
+    """Apply weight-only quantization to the UNet and text encoder.
+
+    The VAE is deliberately left unquantized — quantizing it is a known
+    black-image failure mode.
+    """
+    if QUANTIZE == "none":
+        return
+    if QUANTIZE != "int8_weight_only":
+        logger.warning(f"Unknown QUANTIZE value: {QUANTIZE}, skipping quantization")
+        return
+
+    try:
+        from torchao.quantization import quantize_, int8_weight_only
+    except ImportError:
+        logger.warning("torchao not installed, skipping quantization")
+        return
+
+    logger.info("Applying int8 weight-only quantization to UNet and text encoder")
+    quantize_(pipeline.unet, int8_weight_only())
+    quantize_(pipeline.text_encoder, int8_weight_only())
+
+def _pin_scheduler_to_device(pipeline):
+    """Keep the scheduler's tensor state on the pipeline's device.
+
+    DPMSolver keeps timesteps/sigmas on the CPU, forcing a CPU-GPU sync per
+    denoise step (and graph breaks under torch.compile). Move existing
+    tensors over and wrap set_timesteps so the buffers it rebuilds per
+    generation land on the device too.
+    """
+    if not torch.cuda.is_available():
+        return
+
+    scheduler = pipeline.scheduler
+    device = pipeline.device
+
+    def _move_tensors():
+        for name, value in vars(scheduler).items():
+            if torch.is_tensor(value) and value.device != device:
+                setattr(scheduler, name, value.to(device))
+
+    _move_tensors()
+
+    original_set_timesteps = scheduler.set_timesteps
+
+    def set_timesteps(*args, **kwargs):
+        result = original_set_timesteps(*args, **kwargs)
+        _move_tensors()
+        return result
+
+    scheduler.set_timesteps = set_timesteps
+
+def _compile_pipeline(pipeline):
+    """Optimize the pipeline's UNet for GPU inference.
+
+    Memory-efficient attention (SDPA flash kernels on torch >= 2.0,
+    xformers otherwise) avoids materializing the N x N attention matrix;
+    channels_last lets cuDNN pick faster conv kernels; torch.compile in
+    reduce-overhead mode fuses the pointwise ops in the denoise loop and
+    replays a CUDA graph per step. Compilation is opt-in via COMPILE_UNET
+    since the first generation per model absorbs the warmup cost.
+    """
+    if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        pipeline.unet.set_attn_processor(AttnProcessor2_0())
+    else:
+        try:
+            pipeline.enable_xformers_memory_efficient_attention()
+        except Exception as e:
+            logger.warning(f"Could not enable memory-efficient attention: {e}")
+
+    # Slicing decodes the batch one image at a time — near-free and keeps
+    # the VAE's activation peak flat
+    pipeline.enable_vae_slicing()
+
+    # NHWC layout for both conv-heavy modules; cuDNN's Tensor Core conv
+    # kernels expect channels_last and fall back to slower paths on NCHW
+    pipeline.unet.to(memory_format=torch.channels_last)
+    pipeline.vae.to(memory_format=torch.channels_last)
+    if COMPILE_UNET:
+        backend = "inductor"
+        if COMPILE_BACKEND == "tensorrt":
+            try:
+                import torch_tensorrt  # noqa: F401 -- registers the backend
+                backend = "tensorrt"
+            except ImportError:
+                logger.warning(
+                    "COMPILE_BACKEND=tensorrt but torch_tensorrt is not "
+                    "installed; falling back to inductor"
+                )
+        logger.info(f"Compiling UNet with torch.compile/{backend} (first generation will be slow)")
+        pipeline.unet = torch.compile(
+            pipeline.unet, mode="reduce-overhead", fullgraph=True, backend=backend
+        )
+
+def _cache_pipeline(model_name: str, pipeline):
+    """Insert a pipeline into the LRU cache, evicting as needed.
+
+    Evicts least-recently-used pipelines while the cache exceeds
+    MAX_CACHED_MODELS or free GPU memory sits below MIN_FREE_GPU_BYTES,
+    always keeping the entry just inserted.
+    """
+    models_cache[model_name] = pipeline
+    models_cache.move_to_end(model_name)
+
+    def over_budget() -> bool:
+        if len(models_cache) > MAX_CACHED_MODELS:
+            return True
+        if torch.cuda.is_available():
+            free_bytes, _ = torch.cuda.mem_get_info()
+            return free_bytes < MIN_FREE_GPU_BYTES
+        return False
+
+    while len(models_cache) > 1 and over_budget():
+        evicted_name, evicted = models_cache.popitem(last=False)
+        logger.info(f"Evicting model from cache: {evicted_name}")
+        del evicted
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def load_model(model_name: str):
+    """Load a Stable Diffusion model from ComfyUI directory."""
+    # One load at a time: concurrent requests for the same model would
+    # otherwise both pay the multi-second load and double-allocate VRAM
+    with _load_lock:
+        return _load_model_locked(model_name)
+
+def _load_model_locked(model_name: str):
+    if model_name in models_cache:
+        models_cache.move_to_end(model_name)
+        return models_cache[model_name]
+
+    # Find the model path
+    model_path = find_model_path(model_name)
+    if not model_path:
+        # Try to load from HuggingFace hub
+        model_path = model_name
+    
+    try:
+        logger.info(f"Loading model: {model_path}")
+        
+        # Check if it's a .ckpt file
+        if model_path.endswith('.ckpt'):
+            logger.info(f"Converting checkpoint file: {model_path}")
+            # Convert checkpoint to diffusers format with safe globals
+            with torch.serialization.safe_globals(['pytorch_lightning.callbacks.model_checkpoint.ModelCheckpoint']):
+                pipeline = download_from_original_stable_diffusion_ckpt(
+                    checkpoint_path_or_dict=model_path,
+                    from_safetensors=False,
+                    load_safety_checker=False,
+                    extract_ema=True,
+                    device="cuda" if torch.cuda.is_available() else "cpu",
+                    local_files_only=True
+                )
+            # The converter loads at float32; cast down for GPU inference
+            pipeline = pipeline.to(TORCH_DTYPE)
+        elif model_path.endswith('.safetensors'):
+            logger.info(f"Loading safetensors file: {model_path}")
+            # from_single_file memory-maps the safetensors weights instead
+            # of the legacy converter's read-everything-into-RAM pass —
+            # several GB less host copying and a 2-4x faster first load
+            pipeline = StableDiffusionPipeline.from_single_file(
+                model_path,
+                torch_dtype=TORCH_DTYPE,
+                load_safety_checker=False,
+                use_safetensors=True,
+                local_files_only=True
+            )
+        else:
+            # Try to load from HuggingFace hub or local path
+            try:
+                pipeline = StableDiffusionPipeline.from_pretrained(
+                    model_path,
+                    torch_dtype=TORCH_DTYPE,
+                    safety_checker=None,
+                    requires_safety_checker=False
+                )
+            except Exception as hf_error:
+                logger.warning(f"Failed to load from HuggingFace: {hf_error}")
+                # Fallback to a known working model
+                logger.info("Falling back to stable-diffusion-v1-5")
+                pipeline = StableDiffusionPipeline.from_pretrained(
+                    "runwayml/stable-diffusion-v1-5",
+                    torch_dtype=TORCH_DTYPE,
+                    safety_checker=None,
+                    requires_safety_checker=False
+                )
+        
+        # Move to GPU if available
+        if torch.cuda.is_available():
+            pipeline = pipeline.to("cuda")
+            # fp16 VAE decodes can overflow to black images; force_upcast
+            # runs just the VAE forward in fp32 when needed
+            pipeline.vae.config.force_upcast = True
+            logger.info("Model loaded on GPU")
+            _quantize_pipeline(pipeline)
+            _compile_pipeline(pipeline)
+        else:
+            logger.info("Model loaded on CPU")
+
+        # Set scheduler: SDE-DPM++ with Karras sigmas converges in ~4-8
+        # steps instead of the 20+ the plain multistep solver needs; the
+        # configuration lives in SAMPLER_CLASSES so request-time swaps
+        # rebuild the same solver
+        sampler_cls, sampler_kwargs = SAMPLER_CLASSES["dpm++"]
+        pipeline.scheduler = sampler_cls.from_config(
+            pipeline.scheduler.config, **sampler_kwargs
+        )
+        _pin_scheduler_to_device(pipeline)
+
+        _cache_pipeline(model_name, pipeline)
+        return pipeline
+        
+    except Exception as e:
+        logger.error(f"Failed to load model {model_name}: {str(e)}")
+        # Fallback to a known working model
+        logger.info("Falling back to stable-diffusion-v1-5")
+        try:
+            pipeline = StableDiffusionPipeline.from_pretrained(
+                "runwayml/stable-diffusion-v1-5",
+                torch_dtype=TORCH_DTYPE,
+                safety_checker=None,
+                requires_safety_checker=False
+            )
+            if torch.cuda.is_available():
+                pipeline = pipeline.to("cuda")
+            pipeline.scheduler = DPMSolverMultistepScheduler.from_config(pipeline.scheduler.config)
+            _cache_pipeline(model_name, pipeline)
+            return pipeline
+        except Exception as fallback_error:
+            logger.error(f"Fallback model also failed: {fallback_error}")
+            raise
+
+def _tensor_to_pil(img_tensor) -> Image.Image:
+    """Copy a (3, H, W) float image tensor off the GPU and wrap it in PIL.
+
+    Stages the copy through a reusable pinned host buffer so the PCIe
+    transfer doesn't stall on pageable memory; the numpy view of the
+    buffer is zero-copy.
+    """
+    byte_t = img_tensor.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+    if byte_t.device.type != "cuda":
+        return Image.fromarray(byte_t.permute(1, 2, 0).numpy())
+
+    key = tuple(byte_t.shape)
+    buf = _pinned_buffers.get(key)
+    if buf is None:
+        buf = torch.empty(byte_t.shape, dtype=torch.uint8, pin_memory=True)
+        _pinned_buffers[key] = buf
+    buf.copy_(byte_t, non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+    return Image.fromarray(buf.permute(1, 2, 0).numpy())
+
+def _get_prompt_embeds(pipeline, model_name: str, prompt: str, negative_prompt: str):
+    """Return (prompt_embeds, negative_prompt_embeds), cached per prompt pair.
+
+    Encoding the prompt costs 30-80ms per request on GPU (more on CPU) and
+    sits in a torch.compile graph-break region; repeat prompts hit the
+    cache instead.
+    """
+    key = (model_name, prompt, negative_prompt)
+    cached = _emb_cache.get(key)
+    if cached is not None:
+        _emb_cache.move_to_end(key)
+        return cached
+
+    with torch.inference_mode():
+        pos, neg = pipeline.encode_prompt(
+            prompt,
+            pipeline.device,
+            1,
+            True,
+            negative_prompt,
+        )
+
+    _emb_cache[key] = (pos, neg)
+    while len(_emb_cache) > MAX_CACHED_EMBEDS:
+        _emb_cache.popitem(last=False)
+    return pos, neg
+
+async def generate_image_task(task: GenerationTask):
+    """Background task to generate an image."""
+    # Queue behind any generation already holding the GPU
+    task.status = "queued"
+    async with GPU_SEM:
+        await _generate_image_locked(task)
+    # Terminal either way now; later identical requests get a fresh task.
+    # Only remove the mapping if it still points at us — a newer task may
+    # have claimed the key while we were checkpointing.
+    if task.dedup_key is not None and _inflight.get(task.dedup_key) == task.task_id:
+        _inflight.pop(task.dedup_key, None)
+
+async def _generate_image_locked(task: GenerationTask):
+    try:
+        task.status = "processing"
+        task.start_time = time.time()
+        
+        # Set seed first (before any model loading)
+        if task.request.seed == -1:
+            seed = torch.randint(0, 2**32 - 1, (1,)).item()
+        else:
+            seed = task.request.seed
+        
+        # Set the seed globally for reproducibility
+        torch.manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.manual_seed(seed)
+            torch.cuda.manual_seed_all(seed)
+        
+        logger.info(f"Using seed: {seed} for task {task.task_id}")
+        
+        # Load model if not already loaded; runs in a worker thread so a
+        # cold load (and the lock it holds) doesn't freeze the event loop
+        pipeline = await asyncio.to_thread(load_model, task.request.model)
+        task.progress = 10
+
+        # Swap the scheduler when the request asks for a different sampler,
+        # applying that sampler's configured kwargs so e.g. a "dpm++"
+        # request after a euler one gets the SDE/Karras solver back
+        sampler_entry = SAMPLER_CLASSES.get(task.request.sampler)
+        if sampler_entry is not None:
+            sampler_cls, sampler_kwargs = sampler_entry
+            if not isinstance(pipeline.scheduler, sampler_cls):
+                pipeline.scheduler = sampler_cls.from_config(
+                    pipeline.scheduler.config, **sampler_kwargs
+                )
+                _pin_scheduler_to_device(pipeline)
+
+        # Tile the VAE decode for large outputs (or on request) so its
+        # activations don't spike VRAM into OOM at >= 768^2
+        if task.request.vae_tiling or max(task.request.width, task.request.height) >= 768:
+            pipeline.enable_vae_tiling()
+        else:
+            pipeline.disable_vae_tiling()
+
+        # Generate image
+        logger.info(f"Generating image for task {task.task_id} with model: {task.request.model}")
+        
+        # Reuse the per-device generator, reseeded for this request;
+        # setdefault would build (and discard) a Generator on every hit
+        if pipeline.device not in _generators:
+            _generators[pipeline.device] = torch.Generator(device=pipeline.device)
+        generator = _generators[pipeline.device].manual_seed(seed)
+        
+        # Real per-step progress for /status: denoising spans 10-85, the
+        # VAE decode and save cover the rest
+        total_steps = task.request.steps
+
+        def _on_step_end(pipe, step, timestep, callback_kwargs):
+            task.progress = 10 + int(75 * (step + 1) / total_steps)
+            return callback_kwargs
+
+        # On GPU, take the raw tensor and stage the D2H copy through a
+        # pinned buffer instead of letting diffusers do a pageable copy
+        on_cuda = pipeline.device.type == "cuda"
+
+        # The denoise loop is synchronous; run it in a worker thread so
+        # /status polls actually see the per-step progress updates instead
+        # of queueing behind the whole generation. GPU_SEM already keeps
+        # generations serial. inference_mode skips autograd view/version
+        # tracking that no_grad still pays for.
+        def _run_pipeline():
+            # Encode (or fetch cached) text embeddings outside the denoise
+            # loop; a cache miss runs a CLIP forward, which belongs on this
+            # worker thread, not the event loop
+            prompt_embeds, negative_prompt_embeds = _get_prompt_embeds(
+                pipeline, task.request.model,
+                task.request.prompt, task.request.negative_prompt,
+            )
+            with torch.inference_mode():
+                result = pipeline(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    width=task.request.width,
+                    height=task.request.height,
+                    num_inference_steps=task.request.steps,
+                    guidance_scale=task.request.cfg_scale,
+                    generator=generator,
+                    callback_on_step_end=_on_step_end,
+                    output_type="pt" if on_cuda else "pil",
+                )
+                return (
+                    _tensor_to_pil(result.images[0]) if on_cuda else result.images[0]
+                )
+
+        image = await asyncio.to_thread(_run_pipeline)
+
+        # Save image off the event loop in the requested format
+        fmt = task.request.format if task.request.format in IMAGE_FORMATS else "webp"
+        ext, mime_type, save_kwargs = IMAGE_FORMATS[fmt]
+        image_filename = f"{task.task_id}{ext}"
+        image_path = os.path.join(OUTPUT_DIR, image_filename)
+
+        if task.request.return_base64:
+            # Encode once and let the same bytes back both the saved file
+            # and the inline base64 payload
+            def _encode_and_write() -> str:
+                buf = io.BytesIO()
+                image.save(buf, format=fmt.upper(), **save_kwargs)
+                data = buf.getvalue()
+                Path(image_path).write_bytes(data)
+                return base64.b64encode(data).decode()
+
+            img_base64 = await _run_pil(_encode_and_write)
+        else:
+            # Clients that only want image_url skip the in-memory encode;
+            # get_result encodes lazily from disk if asked later
+            img_base64 = None
+            await _run_pil(image.save, image_path, fmt.upper(), **save_kwargs)
+
+        task.end_time = time.time()
+        task.status = "completed"
+        task.progress = 100
+        
+        task.result = {
+            "image_url": f"/images/{image_filename}",
+            "image_data": img_base64,
+            # Consumers storing the bytes elsewhere need the real encoding;
+            # the default is WebP, not the PNG older clients assumed
+            "format": fmt,
+            "mime_type": mime_type,
+            "generation_time": f"{task.end_time - task.start_time:.2f}s",
+            "model_version": task.request.model,
+            "seed": seed,
+            "actual_model_used": pipeline.__class__.__name__
+        }
+        
+        logger.info(f"Image generation completed for task {task.task_id} with seed {seed}")
+
+        await _checkpoint_task(task)
+
+    except Exception as e:
+        task.status = "failed"
+        task.error = str(e)
+        logger.error(f"Image generation failed for task {task.task_id}: {str(e)}")
+
+async def _checkpoint_task(task: GenerationTask):
+    """Persist a completed task's metadata so results survive restarts.
+
+    The inline base64 payload is dropped — get_result re-encodes from the
+    saved image file on demand — so checkpoints stay a few hundred bytes.
+    """
+    payload = {
+        "task_id": task.task_id,
+        "status": task.status,
+        "created_at": task.created_at,
+        "start_time": task.start_time,
+        "end_time": task.end_time,
+        "request": task.request.model_dump(),
+        "result": {**task.result, "image_data": None},
+    }
+    path = os.path.join(TASKS_DIR, f"{task.task_id}.json")
+    try:
+        async with aiofiles.open(path, "w") as f:
+            await f.write(json.dumps(payload))
+    except OSError as e:
+        logger.warning(f"Could not checkpoint task {task.task_id}: {e}")
+
+def _rehydrate_tasks() -> int:
+    """Reload checkpointed tasks into the store, oldest first."""
+    payloads = []
+    try:
+        with os.scandir(TASKS_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    payloads.append(json.loads(Path(entry.path).read_text()))
+                except (OSError, ValueError):
+                    logger.warning(f"Skipping unreadable task checkpoint: {entry.name}")
+    except OSError:
+        return 0
+
+    # Insert in creation order so the store's oldest-first pruning holds
+    payloads.sort(key=lambda p: p.get("created_at", 0.0))
+    for payload in payloads:
+        # One malformed checkpoint must not abort the whole rehydrate
+        try:
+            task = GenerationTask(payload["task_id"], GenerationRequest(**payload["request"]))
+            task.status = payload["status"]
+        except (KeyError, TypeError, ValidationError):
+            logger.warning(f"Skipping malformed task checkpoint: {payload.get('task_id')!r}")
+            continue
+        task.progress = 100
+        task.created_at = payload.get("created_at", task.created_at)
+        task.start_time = payload.get("start_time")
+        task.end_time = payload.get("end_time")
+        task.result = payload.get("result")
+        tasks[task.task_id] = task
+    _prune_tasks()
+    return len(tasks)
+
+@app.on_event("startup")
+async def startup_event():
+    """Initialize the service on startup."""
+    logger.info("Starting Image Generation Service")
+    logger.info(f"ComfyUI models directory: {COMFYUI_MODELS_DIR}")
+    logger.info(f"Output directory: {OUTPUT_DIR}")
+
+    restored = _rehydrate_tasks()
+    if restored:
+        logger.info(f"Restored {restored} completed tasks from checkpoints")
+
+
+    # Check for available models
+    models = get_available_models()
+    total_models = sum(len(model_list) for model_list in models.values())
+    logger.info(f"Found {total_models} models in ComfyUI directory")
+    
+    # Log model counts by type
+    for model_type, model_list in models.items():
+        if model_list:
+            logger.info(f"  {model_type}: {len(model_list)} models")
+    
+    # Check GPU availability
+    if torch.cuda.is_available():
+        logger.info(f"GPU available: {torch.cuda.get_device_name(0)}")
+        logger.info(f"GPU memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+    else:
+        logger.warning("No GPU available, using CPU")
+
+    # When compiling, absorb the torch.compile warmup now so the first user
+    # request doesn't pay the ~60-80s recompile cost
+    if COMPILE_UNET and torch.cuda.is_available():
+        warmup_model = os.getenv("WARMUP_MODEL", "runwayml/stable-diffusion-v1-5")
+        try:
+            logger.info(f"Warming up compiled pipeline with model: {warmup_model}")
+            warmup_pipeline = load_model(warmup_model)
+            with torch.inference_mode():
+                warmup_pipeline(prompt="warmup", num_inference_steps=1, width=512, height=512)
+            logger.info("Pipeline warmup complete")
+        except Exception as e:
+            logger.warning(f"Pipeline warmup failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the image-encoding pool on shutdown."""
+    _pil_pool.shutdown(wait=False)
+
+@app.get("/")
+async def root():
+    """Health check endpoint."""
+    models = get_available_models()
+    total_models = sum(len(model_list) for model_list in models.values())
+    
+    return {
+        "service": "Image Generation Service",
+        "status": "running",
+        "gpu_available": torch.cuda.is_available(),
+        "models_loaded": list(models_cache.keys()),
+        "total_models_found": total_models,
+        "comfyui_models_dir": COMFYUI_MODELS_DIR
+    }
+
+@app.get("/models")
+async def list_models():
+    """List available models from ComfyUI directory."""
+    models = get_available_models()
+    return {
+        "available_models": models,
+        "loaded_models": list(models_cache.keys()),
+        "comfyui_models_dir": COMFYUI_MODELS_DIR
+    }
+
+@app.get("/models/checkpoints")
+async def list_checkpoints():
+    """List available checkpoint models."""
+    models = get_available_models()
+    return {
+        "checkpoints": models["checkpoints"],
+        "total": len(models["checkpoints"])
+    }
+
+@app.get("/models/text2image")
+async def list_text2image_models():
+    """List all models capable of text-to-image generation."""
+    models = get_available_models()
+    
+    # Filter for text-to-image capable models
+    text2image_models = []
+    
+    # Add all checkpoint models (main text-to-image models)
+    for model in models["checkpoints"]:
+        text2image_models.append({
+            "name": model,
+            "type": "checkpoint",
+            "category": "main"
+        })
+    
+    # Add LoRA models that can be used for text-to-image
+    for model in models["loras"]:
+        # Include useful LoRAs for text-to-image generation
+        if any(keyword in model.lower() for keyword in [
+            "dmd2", "lightning", "faceid", "contrast", "offset", "vega", 
+            "realistic", "real", "photorealistic", "photo", "anime", 
+            "cartoon", "art", "style", "enhance", "improve", "hyper",
+            "lcm", "realism", "mjv6"
+        ]):
+            text2image_models.append({
+                "name": model,
+                "type": "lora",
+                "category": "style"
+            })
+    
+    return {
+        "models": text2image_models,
+        "total": len(text2image_models),
+        "categories": {
+            "checkpoints": len([m for m in text2image_models if m["type"] == "checkpoint"]),
+            "loras": len([m for m in text2image_models if m["type"] == "lora"])
+        }
+    }
+
+# In-flight dedup: maps a request's canonical payload to the task already
+# queued or running for it, so identical submissions share one GPU run.
+# Random-seed requests (seed == -1) are excluded — each is a distinct draw.
+_inflight: Dict[str, str] = {}
+
+def _dedup_key(request: GenerationRequest) -> Optional[str]:
+    if request.seed == -1:
+        return None
+    return json.dumps(request.model_dump(), sort_keys=True)
+
+def _prune_tasks():
+    """Evict expired and over-budget tasks, oldest first.
+
+    Tasks are inserted in creation order, so the front of the dict is
+    always the oldest; still-running tasks keep executing, they just
+    stop being queryable once expired.
+    """
+    now = time.time()
+    while tasks:
+        oldest = next(iter(tasks.values()))
+        if len(tasks) > TASK_CACHE_MAX or now - oldest.created_at > TASK_CACHE_TTL:
+            tasks.popitem(last=False)
+        else:
+            break
+
+@app.post("/generate")
+async def generate_image(request: GenerationRequest, background_tasks: BackgroundTasks):
+    """Start an image generation task."""
+    dedup_key = _dedup_key(request)
+    if dedup_key is not None:
+        existing_id = _inflight.get(dedup_key)
+        existing = tasks.get(existing_id) if existing_id else None
+        if existing is not None and existing.status in ("pending", "queued", "processing"):
+            logger.info(f"Joining in-flight task {existing_id} for identical request")
+            return {
+                "task_id": existing_id,
+                "status": "started",
+                "message": "Identical generation already in flight"
+            }
+
+    task_id = str(uuid.uuid4())
+    task = GenerationTask(task_id, request)
+    tasks[task_id] = task
+    _prune_tasks()
+    if dedup_key is not None:
+        _inflight[dedup_key] = task_id
+        task.dedup_key = dedup_key
+    
+    # Start background task
+    background_tasks.add_task(generate_image_task, task)
+    
+    logger.info(f"Started generation task {task_id} for prompt: {request.prompt[:50]}...")
+    
+    return {
+        "task_id": task_id,
+        "status": "started",
+        "message": "Image generation started"
+    }
+
+@app.get("/status/{task_id}")
+async def get_status(task_id: str):
+    """Get the status of a generation task."""
+    _prune_tasks()
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    task = tasks[task_id]
+    return {
+        "task_id": task_id,
+        "status": task.status,
+        "progress": task.progress,
+        "error": task.error
+    }
+
+@app.get("/result/{task_id}")
+async def get_result(task_id: str, include_image: bool = True):
+    """Get the result of a completed generation task.
+
+    Pass include_image=false to skip the base64 payload entirely when the
+    client fetches the binary from /images/{filename} instead.
+    """
+    _prune_tasks()
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    task = tasks[task_id]
+
+    if task.status == "completed":
+        result = task.result
+        if not include_image:
+            return {**result, "image_data": None}
+        if result.get("image_data") is None:
+            # Base64 wasn't produced during generation; encode lazily from
+            # the saved file without mutating the stored result
+            image_path = os.path.join(
+                OUTPUT_DIR, os.path.basename(result["image_url"])
+            )
+            if os.path.exists(image_path):
+                async with aiofiles.open(image_path, "rb") as f:
+                    raw = await f.read()
+                result = {**result, "image_data": base64.b64encode(raw).decode()}
+        else:
+            # Drop the stored inline copy after first retrieval; later
+            # calls re-encode from disk, keeping resident memory flat
+            task.result = {**task.result, "image_data": None}
+        return result
+    elif task.status == "failed":
+        raise HTTPException(status_code=400, detail=f"Generation failed: {task.error}")
+    else:
+        raise HTTPException(status_code=202, detail="Task still processing")
+
+@app.get("/images/{filename}")
+async def get_image(filename: str):
+    """Serve generated images."""
+    image_path = os.path.join(OUTPUT_DIR, filename)
+    try:
+        stat_result = os.stat(image_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    from fastapi.responses import FileResponse
+    ext = os.path.splitext(filename)[1].lower()
+    # Filenames are task UUIDs, so content never changes under a name:
+    # safe to mark immutable and let clients/proxies cache for a year
+    return FileResponse(
+        image_path,
+        media_type=_MIME_BY_EXT.get(ext),
+        stat_result=stat_result,
+        headers={
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{filename}"',
+        },
+    )
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str):
+    """Cancel a generation task."""
+    if task_id not in tasks:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    task = tasks[task_id]
+    if task.status in ["pending", "processing"]:
+        task.status = "cancelled"
+        return {"message": "Task cancelled"}
+    else:
+        raise HTTPException(status_code=400, detail="Cannot cancel completed or failed task")
+
+if __name__ == "__main__":
+    # Get configuration from environment
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8001"))
+    # The task store, model cache, and GPU semaphore are process-local, so
+    # the default stays at one worker; raise WORKERS only behind a shared
+    # store. loop/http "auto" picks uvloop and httptools when installed.
+    workers = int(os.getenv("WORKERS", "1"))
+
+    logger.info(f"Starting server on {host}:{port} ({workers} worker(s))")
+    uvicorn.run(
+        "image_generation_service:app",
+        host=host,
+        port=port,
+        loop="auto",
+        http="auto",
+        workers=workers,
+    )
\ No newline at end of file
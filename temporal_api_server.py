@@ -5,43 +5,141 @@ This server acts as a bridge between the admin interface and Temporal workflows
 """
 
 import asyncio
+import base64
 import json
-import uuid
+import secrets
+import time
 import os
 import aiohttp
-from datetime import datetime
-from typing import Dict, Any
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Any, Optional
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from temporalio.client import Client
+from temporalio.client import WorkflowExecutionStatus
+from temporalio.service import RPCError
 
 # Import the starter module
-from app.starter import main as start_workflow
+from app.starter import get_client
+from app.models import Text2ImageRequest
 from app.workflows import Text2ImageWorkflow
 
-app = FastAPI(title="Temporal API Server", version="1.0.0")
+# orjson encodes the large result payloads several times faster than the
+# stdlib encoder; fall back silently when it isn't installed
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse
+    _default_response_class = ORJSONResponse
+    _json_dumps = orjson.dumps
+except ImportError:
+    from fastapi.responses import JSONResponse as _default_response_class
 
-# Add CORS middleware
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+app = FastAPI(
+    title="Temporal API Server",
+    version="1.0.0",
+    default_response_class=_default_response_class,
+)
+
+@app.on_event("startup")
+async def startup_event():
+    """Connect to Temporal once; every workflow start reuses the channel."""
+    # get_client caches the connection, so gRPC handshake + namespace
+    # negotiation happen once instead of per /generate call
+    app.state.temporal_client = await get_client()
+    # Cap concurrent submissions so a burst doesn't flood the shared
+    # channel and the Temporal frontend
+    app.state.submit_sem = asyncio.Semaphore(int(os.getenv("SUBMIT_CONCURRENCY", "32")))
+    # One pooled session for all outbound HTTP (image-service proxying):
+    # per-call ClientSession() pays TCP+TLS setup and teardown every time.
+    # Don't open ad-hoc sessions in handlers — route through app.state.http.
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=10),
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the pooled HTTP session."""
+    await app.state.http.close()
+
+# Add CORS middleware. An explicit origin allowlist lets Starlette emit
+# static headers per response instead of reflecting the request origin;
+# the default covers the local admin interface.
+CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:8080,http://localhost:3000").split(",")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["content-type", "authorization"],
 )
 
-# Store workflow status
-workflow_status: Dict[str, Dict[str, Any]] = {}
+# Local cache of workflow status; Temporal itself is the source of truth,
+# so /status falls back to describe() for workflows this process didn't
+# start (other replicas, restarts). Insertion-ordered and bounded by size
+# and age so the cache doesn't grow with the lifetime of the process.
+workflow_status: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+STATUS_CACHE_MAX = int(os.getenv("STATUS_CACHE_MAX", "10000"))
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", "3600"))
+
+# Response bytes for terminal workflows, encoded once on first read;
+# evicted together with the status entry they mirror
+_encoded_status: Dict[str, bytes] = {}
+
+def _prune_workflow_status():
+    """Evict the oldest cached workflows past the size or age bound"""
+    now = time.time()
+    while workflow_status:
+        oldest = next(iter(workflow_status.values()))
+        if (len(workflow_status) > STATUS_CACHE_MAX
+                or now - oldest["created_at"] > STATUS_CACHE_TTL):
+            evicted_id, _ = workflow_status.popitem(last=False)
+            _encoded_status.pop(evicted_id, None)
+        else:
+            break
+
+_EXECUTION_STATUS_NAMES = {
+    WorkflowExecutionStatus.RUNNING: "running",
+    WorkflowExecutionStatus.COMPLETED: "completed",
+    WorkflowExecutionStatus.FAILED: "failed",
+    WorkflowExecutionStatus.CANCELED: "canceled",
+    WorkflowExecutionStatus.TERMINATED: "terminated",
+    WorkflowExecutionStatus.CONTINUED_AS_NEW: "running",
+    WorkflowExecutionStatus.TIMED_OUT: "failed",
+}
 
 # Image service URL
 IMAGE_SERVICE_URL = os.getenv("IMAGE_SERVICE_URL", "http://localhost:8000")
 
+# Spill directory for inline image payloads; serving bytes from disk via
+# sendfile beats shipping megabyte base64 strings through JSON
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./workflow_images")
+os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+
+# Spilled-file extension by the MIME the workflow result reports (and back
+# again for serving); PNG covers results from older service builds
+_EXT_BY_MIME = {"image/png": ".png", "image/webp": ".webp", "image/jpeg": ".jpg"}
+_MIME_BY_EXT = {ext: mime for mime, ext in _EXT_BY_MIME.items()}
+
+# Shared defaults, hoisted so the 350-byte negative prompt is one interned
+# module-level string instead of living inline in the schema
+DEFAULT_NEGATIVE_PROMPT = (
+    "blurry, distorted, low quality, low resolution, poorly drawn, "
+    "bad anatomy, disfigured, deformed, extra limbs, mutated, watermark, "
+    "text, signature, grainy, noisy, overexposed, underexposed, ugly"
+)
+DEFAULT_MODEL = "runwayml/stable-diffusion-v1-5"
+
 class ImageGenerationRequest(BaseModel):
     prompt: str
-    negative_prompt: str = "blurry, distorted, low quality, low resolution, poorly drawn, bad anatomy, disfigured, deformed, extra limbs, mutated, watermark, text, signature, grainy, noisy, overexposed, underexposed, ugly"
-    model: str = "runwayml/stable-diffusion-v1-5"
+    negative_prompt: str = DEFAULT_NEGATIVE_PROMPT
+    model: str = DEFAULT_MODEL
     width: int = 512
     height: int = 512
     steps: int = 20
@@ -51,10 +149,9 @@ class ImageGenerationRequest(BaseModel):
 async def get_image_service_status():
     """Get status from the image generation service"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{IMAGE_SERVICE_URL}/") as response:
-                if response.status == 200:
-                    return await response.json()
+        async with app.state.http.get(f"{IMAGE_SERVICE_URL}/") as response:
+            if response.status == 200:
+                return await response.json()
     except Exception as e:
         print(f"Failed to get image service status: {e}")
     return None
@@ -93,73 +190,144 @@ async def root():
 @app.post("/generate")
 async def generate_image(request: ImageGenerationRequest):
     """Start a Temporal workflow for image generation"""
+    # Generate unique workflow ID; token_hex yields the same 8 hex chars
+    # the sliced uuid4 did without building a full UUID first
+    workflow_id = f"text2image-{secrets.token_hex(4)}"
+
+    # Starting a workflow only enqueues it, so do it inline — failures
+    # surface in this response instead of a dangling background task
     try:
-        # Generate unique workflow ID
-        workflow_id = f"text2image-{uuid.uuid4().hex[:8]}"
-        
-        # Store initial status
-        workflow_status[workflow_id] = {
-            "workflow_id": workflow_id,
-            "status": "starting",
-            "created_at": datetime.now().isoformat(),
-            "request": request.model_dump(),
-            "result": None,
-            "error": None
-        }
-        
-        # Start workflow in background
-        asyncio.create_task(run_workflow(workflow_id, request))
-        
-        return {
-            "task_id": workflow_id,
-            "workflow_id": workflow_id,
-            "status": "starting",
-            "message": "Workflow started successfully"
-        }
-        
+        async with app.state.submit_sem:
+            handle = await app.state.temporal_client.start_workflow(
+                Text2ImageWorkflow.run,
+                Text2ImageRequest(
+                    prompt=request.prompt,
+                    model=request.model,
+                    negative_prompt=request.negative_prompt,
+                    width=request.width,
+                    height=request.height,
+                    steps=request.steps,
+                    cfg_scale=request.cfg_scale,
+                    seed=request.seed,
+                ),
+                id=workflow_id,
+                task_queue="hello-python-tq",
+            )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to start workflow: {str(e)}")
 
-async def run_workflow(workflow_id: str, request: ImageGenerationRequest):
-    """Run the Temporal workflow in background"""
+    workflow_status[workflow_id] = {
+        "workflow_id": workflow_id,
+        "status": "running",
+        # Epoch floats: a datetime + isoformat per write costs allocations
+        # the hot path doesn't need; clients format at the edge
+        "created_at": time.time(),
+        # Dump straight to JSON-ready primitives so /status and /workflows
+        # reads never re-walk a pydantic object
+        "request": request.model_dump(mode="json"),
+        "result": None,
+        "error": None
+    }
+    _prune_workflow_status()
+
+    # The watcher only holds the handle and id while waiting for the
+    # durable execution to finish
+    asyncio.create_task(_record_workflow_outcome(workflow_id, handle))
+
+    return {
+        "task_id": workflow_id,
+        "workflow_id": workflow_id,
+        "status": "running",
+        "message": "Workflow started successfully"
+    }
+
+async def _record_workflow_outcome(workflow_id: str, handle):
+    """Record the terminal state of a workflow in the local status cache"""
     try:
-        # Update status to running
-        workflow_status[workflow_id]["status"] = "running"
-        workflow_status[workflow_id]["started_at"] = datetime.now().isoformat()
-        
-        # Connect to Temporal
-        client = await Client.connect("localhost:7233")
-        
-        # Start workflow (queues it for worker to pick up)
-        handle = await client.start_workflow(
-            Text2ImageWorkflow.run,
-            (request.prompt, request.model, request.negative_prompt, 
-             request.width, request.height, request.steps, request.cfg_scale, request.seed),
-            id=workflow_id,
-            task_queue="hello-python-tq",
-        )
-        
-        # Wait for workflow completion
         result = await handle.result()
-        
-        # Update status to completed
-        workflow_status[workflow_id]["status"] = "completed"
-        workflow_status[workflow_id]["completed_at"] = datetime.now().isoformat()
-        workflow_status[workflow_id]["result"] = result
-        
     except Exception as e:
-        # Update status to failed
-        workflow_status[workflow_id]["status"] = "failed"
-        workflow_status[workflow_id]["failed_at"] = datetime.now().isoformat()
-        workflow_status[workflow_id]["error"] = str(e)
+        entry = workflow_status.get(workflow_id)
+        if entry is not None:
+            entry["status"] = "failed"
+            entry["failed_at"] = time.time()
+            entry["error"] = str(e)
+    else:
+        entry = workflow_status.get(workflow_id)
+        if entry is not None:
+            # Keep the multi-hundred-KB inline base64 out of the status
+            # cache: spill inline payloads to disk and rewrite image_url
+            # to this server's /image route — the service-relative URL the
+            # activity passes through doesn't resolve from here. /result
+            # re-encodes from the spilled file when the admin UI asks.
+            if result and result.get("image_data"):
+                ext = _EXT_BY_MIME.get(result.get("mime_type"), ".png")
+                image_path = os.path.join(IMAGE_CACHE_DIR, f"{workflow_id}{ext}")
+                data = base64.b64decode(result["image_data"])
+                await asyncio.to_thread(_write_bytes, image_path, data)
+                result = {
+                    **result,
+                    "image_url": f"/image/{workflow_id}{ext}",
+                    "image_data": None,
+                }
+            # Assign the result before flipping the status: /status caches
+            # terminal bodies, so a poll landing between a "completed" flip
+            # and this assignment (the spill awaits above) would freeze a
+            # result-less body into the encoded cache
+            entry["result"] = result
+            entry["completed_at"] = time.time()
+            entry["status"] = "completed"
+
+def _write_bytes(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+@app.get("/image/{filename}")
+async def get_workflow_image(filename: str):
+    """Serve a spilled workflow image straight from disk"""
+    image_path = os.path.join(IMAGE_CACHE_DIR, os.path.basename(filename))
+    if not os.path.exists(image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    # Ids are random per workflow, so the bytes behind a URL never change
+    return FileResponse(
+        image_path,
+        media_type=_MIME_BY_EXT.get(os.path.splitext(filename)[1].lower(), "image/png"),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
 
 @app.get("/status/{workflow_id}")
 async def get_workflow_status(workflow_id: str):
     """Get the status of a workflow"""
-    if workflow_id not in workflow_status:
+    if workflow_id in workflow_status:
+        entry = workflow_status[workflow_id]
+        # Terminal entries never change again: encode once and replay the
+        # bytes for every later poll
+        if entry["status"] in ("completed", "failed"):
+            body = _encoded_status.get(workflow_id)
+            if body is None:
+                body = _json_dumps(entry)
+                _encoded_status[workflow_id] = body
+            return Response(body, media_type="application/json")
+        return entry
+
+    # Not started by this process — ask Temporal directly so status works
+    # across replicas and restarts
+    try:
+        description = await app.state.temporal_client.get_workflow_handle(
+            workflow_id
+        ).describe()
+    except RPCError:
         raise HTTPException(status_code=404, detail="Workflow not found")
-    
-    return workflow_status[workflow_id]
+
+    return {
+        "workflow_id": workflow_id,
+        "status": _EXECUTION_STATUS_NAMES.get(description.status, "unknown"),
+        "result": None,
+        "error": None,
+    }
 
 @app.get("/result/{workflow_id}")
 async def get_workflow_result(workflow_id: str):
@@ -173,34 +341,97 @@ async def get_workflow_result(workflow_id: str):
     
     # Return the result in the format expected by the admin interface
     if workflow["result"]:
+        result = workflow["result"]
+        image_data = result.get("image_data")
+        image_url = result.get("image_url", "")
+        if not image_data and image_url.startswith("/image/"):
+            # The admin gallery renders only image_data; rebuild it from
+            # the spilled file so the status cache stays payload-free
+            image_path = os.path.join(IMAGE_CACHE_DIR, os.path.basename(image_url))
+            if os.path.exists(image_path):
+                raw = await asyncio.to_thread(_read_bytes, image_path)
+                image_data = base64.b64encode(raw).decode()
         return {
-            "image_data": workflow["result"].get("image_data", ""),
-            "generation_time": workflow["result"].get("generation_time", ""),
-            "model_version": workflow["result"].get("model_version", ""),
-            "seed": workflow["result"].get("seed", ""),
+            "image_data": image_data or "",
+            "image_url": image_url,
+            "mime_type": result.get("mime_type", "image/png"),
+            "generation_time": result.get("generation_time", ""),
+            "model_version": result.get("model_version", ""),
+            "seed": result.get("seed", ""),
             "workflow_id": workflow_id
         }
     else:
         raise HTTPException(status_code=404, detail="No result available")
 
+@app.websocket("/ws/status/{workflow_id}")
+async def watch_workflow(websocket: WebSocket, workflow_id: str):
+    """Push the workflow outcome over one socket instead of /status polling.
+
+    The UI otherwise polls every few hundred ms for the whole generation;
+    here a single await on the workflow result replaces all those round
+    trips with one frame at completion.
+    """
+    await websocket.accept()
+    handle = app.state.temporal_client.get_workflow_handle(workflow_id)
+    try:
+        await websocket.send_json({"workflow_id": workflow_id, "status": "running"})
+        try:
+            result = await handle.result()
+        except Exception as e:
+            await websocket.send_json({
+                "workflow_id": workflow_id,
+                "status": "failed",
+                "error": str(e)
+            })
+        else:
+            # One-shot frame, not a cache entry: keep image_data intact —
+            # it's the only field the admin UI renders from
+            await websocket.send_json({
+                "workflow_id": workflow_id,
+                "status": "completed",
+                "result": result
+            })
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
 @app.get("/workflows")
-async def list_workflows():
-    """List all workflows"""
+async def list_workflows(limit: int = 100, cursor: Optional[str] = None):
+    """List workflows in insertion order, one page at a time.
+
+    Pass the returned next_cursor to fetch the following page; encoding
+    the full history on every GET stalled the event loop once thousands
+    of workflows accumulated.
+    """
+    limit = max(1, min(limit, 1000))
+
+    items = iter(workflow_status.items())
+    if cursor is not None:
+        # Advance past the cursor id; if it was evicted, start from the
+        # oldest remaining entry rather than erroring
+        for wf_id, _ in items:
+            if wf_id == cursor:
+                break
+        else:
+            items = iter(workflow_status.items())
+
+    page = [workflow for _, workflow in islice(items, limit)]
+    next_cursor = page[-1]["workflow_id"] if len(page) == limit else None
     return {
-        "workflows": list(workflow_status.values()),
-        "total": len(workflow_status)
+        "workflows": page,
+        "total": len(workflow_status),
+        "next_cursor": next_cursor
     }
 
 @app.get("/models")
 async def list_models():
     """Proxy models endpoint from image service"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{IMAGE_SERVICE_URL}/models") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise HTTPException(status_code=response.status, detail="Image service error")
+        async with app.state.http.get(f"{IMAGE_SERVICE_URL}/models") as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                raise HTTPException(status_code=response.status, detail="Image service error")
     except aiohttp.ClientError as e:
         raise HTTPException(status_code=503, detail=f"Cannot connect to image service: {str(e)}")
 
@@ -208,22 +439,54 @@ async def list_models():
 async def list_text2image_models():
     """Proxy text2image models endpoint from image service"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{IMAGE_SERVICE_URL}/models/text2image") as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise HTTPException(status_code=response.status, detail="Image service error")
+        async with app.state.http.get(f"{IMAGE_SERVICE_URL}/models/text2image") as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                raise HTTPException(status_code=response.status, detail="Image service error")
     except aiohttp.ClientError as e:
         raise HTTPException(status_code=503, detail=f"Cannot connect to image service: {str(e)}")
 
+# Load balancers poll /health at high rates; a pre-encoded static body
+# makes the endpoint constant-time and allocation-free
+_HEALTH_BODY = _json_dumps({"status": "healthy"})
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return Response(_HEALTH_BODY, media_type="application/json")
 
 if __name__ == "__main__":
     print("Starting Temporal API Server...")
     print("This server bridges HTTP requests to Temporal workflows")
     print("Admin interface should point to this server instead of image service")
-    uvicorn.run(app, host="0.0.0.0", port=8002) 
\ No newline at end of file
+    # loop/http "auto" select uvloop and httptools when installed. The
+    # workflow_status cache is process-local; /status falls back to
+    # Temporal for unknown ids, but inline results only live in the
+    # starting worker, so multi-worker stays opt-in via WEB_CONCURRENCY.
+    # Access-log chatter is off by default; raise LOG_LEVEL to debug it.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    log_level = os.getenv("LOG_LEVEL", "warning")
+    if workers > 1:
+        # The multiprocess supervisor only exists behind uvicorn.run
+        uvicorn.run(
+            "temporal_api_server:app",
+            host="0.0.0.0",
+            port=8002,
+            loop="auto",
+            http="auto",
+            workers=workers,
+            log_level=log_level,
+        )
+    else:
+        # Config + Server on one asyncio.run avoids uvicorn spinning up
+        # its own loop machinery around the app's
+        config = uvicorn.Config(
+            app,
+            host="0.0.0.0",
+            port=8002,
+            loop="auto",
+            http="auto",
+            log_level=log_level,
+        )
+        asyncio.run(uvicorn.Server(config).serve())
\ No newline at end of file